@@ -3,16 +3,24 @@ import sys
 import random
 import math
 import numpy as np
+import torch
 
 
-from utils import load_data, radial_target, radial_occupancy, HEADING_BINS, RANGE_BINS, normalize_angle
+from features import FeatureTable
+from utils import load_data, radial_target_batch, radial_occupancy_batch, radial_target_torch, \
+    radial_occupancy_torch, radial_target_cells, radial_target_from_cells, HEADING_BINS, RANGE_BINS, normalize_angle, normalize_angles
 random.seed(1)
 
 
 class DataLoader:
-    """ Class to handle data loading, data augmentation and batch sampling """
+    """ Class to handle data loading, data augmentation and batch sampling. features is
+        either a FeatureTable, which can be shared between loaders, or a long_id ->
+        feature versions dict as returned by load_img_features. With target_table the
+        target cells of every item under every rotation augmentation are precomputed,
+        so batch targets are rendered from a table lookup. """
 
-    def __init__(self, features, splits=['train'], bs=1, augment=False, dropout=0, laser_fov_deg=270):
+    def __init__(self, features, splits=['train'], bs=1, augment=False, dropout=0, laser_fov_deg=270,
+                 target_table=True):
 
         self.splits = splits
         self.batch_size = bs
@@ -23,18 +31,42 @@ class DataLoader:
         self.data = load_data(splits)
         random.shuffle(self.data)
         self.reset_epoch()
+        self.batch_feature_keys = None
+        self.batch_rotations = None
         print('Loaded %d data tuples from %s' % (len(self.data), self.splits))
 
+        if not isinstance(features, FeatureTable):
+            features = FeatureTable(features)
+        self.features = features
         for item in self.data:
             long_id = item['scan'] + "_" + item['image_id']
-            # reshape to 12 near range views, 12 medium range views, and 12 ceiling views
-            # roll so zero in the middle of the scan (although actually out by 0.5 grid cells)
-            item['features'] = []
-            for feature_version in features[long_id]:
-                item['features'].append(np.roll(feature_version.reshape(3,12,2048), 6, axis=1))
+            # FeatureTable rows are reshaped to 3x12 views, and gathered rolled so zero is
+            # in the middle of the scan (although actually out by 0.5 grid cells)
+            item['feature_rows'] = features.rows.get(long_id, [])
             # which is 15 degrees, so we rotate scan and heading by that much
             item['target_heading'] = np.array([normalize_angle(h + math.pi/12) for h in item['target_heading']])
             item['laser'] = np.roll(item['laser'], int(len(item['laser'])/24))
+        for i,item in enumerate(self.data):
+            item['index'] = i
+        self.target_cells = self._build_target_table() if target_table else None
+
+    def _build_target_table(self):
+        """ Flat target cells of every item under each rotation, shaped (items, rotations, targets)
+            and padded with -1. Computed exactly as get_batch would per sample. """
+        n_items = len(self.data)
+        max_targets = max(len(item['target_heading']) for item in self.data)
+        heading = np.zeros((n_items, max_targets))
+        dist = np.zeros((n_items, max_targets)) # padding has range 0, so it is out of range
+        for i,item in enumerate(self.data):
+            heading[i, :len(item['target_heading'])] = item['target_heading']
+            dist[i, :len(item['target_range'])] = item['target_range']
+        if self.augment:
+            rotations = np.arange(13)
+            heading = normalize_angles(heading[:, None, :] + (math.pi/6)*rotations[None, :, None])
+        else:
+            heading = heading[:, None, :]
+        dist = np.broadcast_to(dist[:, None, :], heading.shape)
+        return radial_target_cells(heading, dist).astype(np.int16)
 
     def reset_epoch(self):
         """ Reset the data index to beginning of epoch. Primarily for testing. """
@@ -53,53 +85,165 @@ class DataLoader:
         self.batch = batch
 
 
+    def _batch_targets(self, rotations):
+        """ Radial target encodings of the current batch, rotated by rotations if augmenting """
+        if self.target_cells is not None:
+            ix = np.array([item['index'] for item in self.batch])
+            return radial_target_from_cells(self.target_cells[ix, rotations if self.augment else 0])
+        tgt_headings = [item['target_heading'] for item in self.batch]
+        if self.augment:
+            n_targets = [len(h) for h in tgt_headings]
+            tgt_heading = normalize_angles(np.concatenate(tgt_headings) + (math.pi/6)*np.repeat(rotations, n_targets))
+            tgt_headings = np.split(tgt_heading, np.cumsum(n_targets)[:-1])
+        return radial_target_batch(tgt_headings, [item['target_range'] for item in self.batch])
+
+
     def get_batch(self):
         """ Prepare next batch for consumption """
         self._next_minibatch()
         scans = np.empty((self.batch_size, 2, RANGE_BINS, HEADING_BINS), dtype=np.float32)
         targets = np.empty((self.batch_size, 1, RANGE_BINS, HEADING_BINS), dtype=np.float32)
-        features = np.empty((self.batch_size, 2048, 3, 12), dtype=np.float32)
 
-        long_ids = []
         assert len(self.batch) == self.batch_size
-        for n,item in enumerate(self.batch):
-            long_ids.append(item['scan'] + "_" + item['image_id'])
+        long_ids = [item['scan'] + "_" + item['image_id'] for item in self.batch]
+        lasers = np.stack([item['laser'] for item in self.batch])
+        length = lasers.shape[1]
+
+        # Draw the random parameters for the whole batch. Scalars are drawn in the same order
+        # as sampling item by item, so seeded runs produce the same batches as before.
+        feature_rows = []
+        versions = []
+        rotations = []
+        miss_starts = []
+        for item in self.batch:
             # Select one feature if there are multiple versions
-            selected_features = random.choice(item['features'])
-
-            if self.augment:
-                # random rotation by a 30 degree increment
-                rotation = random.randint(0,12)
-                ix = int(len(item['laser'])/12*rotation)
-                laser = np.roll(item['laser'], ix) # end rolls around to start
-                tgt_heading = np.array([normalize_angle(h + (math.pi/6)*rotation) for h in item['target_heading']])
-                feat = np.roll(selected_features, rotation, axis=1)
-            else:
-                laser = np.array(item['laser'], copy=True)
-                tgt_heading = item['target_heading']
-                feat = selected_features
-
-            # missing part of scan
-            length = len(laser)
-            miss_start = random.randint(0, length)
-            miss_end = miss_start + int((360-self.laser_fov_deg)/360 * length)
-            laser[miss_start:miss_end] = -1
-            if miss_end >= length:
-                laser[:miss_end-length] = -1
-
-            # dropout. Unlike conventional dropout, this occurs at both train and test time and is 
-            # considered to represent missing return values in the laser scan.
-            drop = np.random.random_sample((len(laser),))
-            laser[drop < self.dropout] = -1  # Indicates missing return.
-
-            scans[n, 1, :, :] = radial_occupancy(laser).transpose((2,0,1))
-            # add a range indicating channel
-            r = np.linspace(-0.5, 0.5, num=RANGE_BINS)
-            scans[:,0,:,:] = np.expand_dims(np.expand_dims(r, axis=0), axis=2)
-            targets[n, :, :, :] = radial_target(tgt_heading, item['target_range']).transpose((2,0,1))
-            features[n, :, :, :] = feat.transpose((2,0,1))
+            versions.append(random.randrange(len(item['feature_rows'])))
+            feature_rows.append(item['feature_rows'][versions[-1]])
+            # random rotation by a 30 degree increment
+            rotations.append(random.randint(0,12) if self.augment else 0)
+            miss_starts.append(random.randint(0, length))
+        # dropout. Unlike conventional dropout, this occurs at both train and test time and is
+        # considered to represent missing return values in the laser scan.
+        drop = np.random.random_sample(lasers.shape)
+        rotations = np.array(rotations)
+        positions = np.arange(length)
+        # Which features this batch used, e.g. for UNet.image_features
+        self.batch_feature_keys = list(zip(long_ids, versions))
+        self.batch_rotations = rotations
+
+        features = self.features.gather(feature_rows, rotations if self.augment else None)
+        if self.augment:
+            # end rolls around to start
+            shift = (length/12*rotations).astype(int)
+            lasers = lasers[np.arange(self.batch_size)[:, None], (positions - shift[:, None]) % length]
+
+        # missing part of scan, wrapping around the end
+        miss_length = int((360-self.laser_fov_deg)/360 * length)
+        missing = (positions - np.array(miss_starts)[:, None]) % length < miss_length
+        lasers[missing] = -1
+        lasers[drop < self.dropout] = -1  # Indicates missing return.
+
+        scans[:, 1, :, :] = radial_occupancy_batch(lasers)
+        # add a range indicating channel
+        r = np.linspace(-0.5, 0.5, num=RANGE_BINS)
+        scans[:,0,:,:] = np.expand_dims(np.expand_dims(r, axis=0), axis=2)
+        targets[:, 0, :, :] = self._batch_targets(rotations)
         # features = np.zeros_like(features)  # How does it work without image features?
         # scans = np.zeros_like(scans)  # How does it work with only image features?
         # Normalize targets into a probability dist
         targets /= targets.reshape(targets.shape[0], -1).sum(axis=1).reshape(-1, 1, 1, 1)
         return scans, features, targets, long_ids
+
+
+class DeviceDataLoader(DataLoader):
+    """ DataLoader that uploads lasers, targets and features to a torch device once,
+        then runs augmentation, occupancy and target encoding there as torch ops.
+        Only the minibatch indices are copied to the device for each batch, and
+        get_batch returns tensors on the device. Random augmentation parameters,
+        the feature version and the missing part of the scan are drawn from a
+        seeded device generator, with the same distributions as DataLoader but a
+        different random stream. So batches only match DataLoader's when none of
+        them are random: without augmentation or dropout, a 360 degree laser and
+        one feature version. """
+
+    def __init__(self, features, device, splits=['train'], bs=1, augment=False, dropout=0, laser_fov_deg=270, seed=1):
+        # Targets are rendered on the device, so skip DataLoader's host target table
+        super(DeviceDataLoader, self).__init__(features, splits, bs, augment, dropout, laser_fov_deg,
+                                               target_table=False)
+        self.device = device
+        self.generator = torch.Generator(device=device)
+        self.generator.manual_seed(seed)
+
+        n_items = len(self.data)
+        max_targets = max(len(item['target_heading']) for item in self.data)
+        max_versions = max(len(item['feature_rows']) for item in self.data)
+        # Padded targets have range 0, which radial_target_torch ignores
+        target_heading = np.zeros((n_items, max_targets))
+        target_range = np.zeros((n_items, max_targets))
+        feature_rows = np.zeros((n_items, max_versions), dtype=np.int64)
+        n_versions = np.zeros(n_items, dtype=np.int64)
+        for i,item in enumerate(self.data):
+            target_heading[i, :len(item['target_heading'])] = item['target_heading']
+            target_range[i, :len(item['target_range'])] = item['target_range']
+            n_versions[i] = len(item['feature_rows'])
+            feature_rows[i, :n_versions[i]] = item['feature_rows']
+        # Only upload the FeatureTable rows this loader uses
+        used_rows, feature_rows = np.unique(feature_rows, return_inverse=True)
+        self.lasers = torch.from_numpy(np.stack([item['laser'] for item in self.data])).to(device)
+        self.target_heading = torch.from_numpy(target_heading).to(device)
+        self.target_range = torch.from_numpy(target_range).to(device)
+        self.feature_rows = torch.from_numpy(feature_rows.reshape(n_items, max_versions)).to(device)
+        self.n_versions = torch.from_numpy(n_versions).to(device)
+        # Features are stored as the model consumes them, (rows, 2048, 3, 12), in the table's precision
+        self.device_features = torch.from_numpy(self.features.gather(used_rows, dtype=self.features.data.dtype)).to(device)
+        r = np.linspace(-0.5, 0.5, num=RANGE_BINS)
+        self.range_channel = torch.from_numpy(r).float().to(device).reshape(1, RANGE_BINS, 1)
+
+    def get_batch(self):
+        """ Prepare next batch for consumption on the device """
+        self._next_minibatch()
+        assert len(self.batch) == self.batch_size
+        long_ids = [item['scan'] + "_" + item['image_id'] for item in self.batch]
+        ix = torch.tensor([item['index'] for item in self.batch], device=self.device)
+        batch_size = self.batch_size
+        length = self.lasers.shape[1]
+        g = self.generator
+        device = self.device
+
+        # Select one feature if there are multiple versions
+        version = (torch.rand(batch_size, generator=g, device=device)*self.n_versions[ix]).long()
+        if self.augment:
+            # random rotation by a 30 degree increment
+            rotation = torch.randint(0, 13, (batch_size,), generator=g, device=device)
+        else:
+            rotation = torch.zeros(batch_size, dtype=torch.long, device=device)
+        miss_start = torch.randint(0, length+1, (batch_size,), generator=g, device=device)
+        drop = torch.rand((batch_size, length), generator=g, device=device)
+
+        positions = torch.arange(length, device=device)
+        lasers = self.lasers[ix]
+        feats = self.device_features[self.feature_rows[ix, version]].float()
+        tgt_heading = self.target_heading[ix]
+        if self.augment:
+            # end rolls around to start
+            shift = (length/12*rotation.double()).long()
+            lasers = lasers.gather(1, (positions - shift[:, None]) % length)
+            n_views = feats.shape[-1]
+            views = (torch.arange(n_views, device=device) - rotation[:, None]) % n_views
+            feats = feats.gather(3, views[:, None, None, :].expand_as(feats))
+            tgt_heading = normalize_angles(tgt_heading + (math.pi/6)*rotation[:, None].double())
+
+        # missing part of scan, wrapping around the end, plus dropout
+        miss_length = int((360-self.laser_fov_deg)/360 * length)
+        missing = (positions - miss_start[:, None]) % length < miss_length
+        lasers = lasers.masked_fill(missing | (drop < self.dropout), -1)
+
+        scans = torch.empty((batch_size, 2, RANGE_BINS, HEADING_BINS), device=device)
+        scans[:, 1, :, :] = radial_occupancy_torch(lasers)
+        # add a range indicating channel
+        scans[:, 0, :, :] = self.range_channel
+        batch_ix = torch.arange(batch_size, device=device)[:, None].expand_as(tgt_heading)
+        targets = radial_target_torch(tgt_heading, self.target_range[ix], batch_ix, batch_size).unsqueeze(1)
+        # Normalize targets into a probability dist
+        targets /= targets.flatten(1).sum(dim=1).reshape(-1, 1, 1, 1)
+        return scans, feats, targets, long_ids
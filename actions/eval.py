@@ -24,6 +24,12 @@ def neighborhoods(mu, x_range, y_range, sigma, circular_x=True, gaussian=False):
     # Generate bivariate Gaussians centered at position mu
     x = torch.arange(start=0,end=x_range, device=mu.device, dtype=mu.dtype).unsqueeze(0).unsqueeze(0)
     y = torch.arange(start=0,end=y_range, device=mu.device, dtype=mu.dtype).unsqueeze(1).unsqueeze(0)
+    return neighborhood_weights(x, y, x_mu, y_mu, x_range, sigma, circular_x, gaussian)
+
+
+def neighborhood_weights(x, y, x_mu, y_mu, x_range, sigma, circular_x=True, gaussian=False):
+    """ Mask values at positions (x, y) of the neighborhoods centred at (x_mu, y_mu),
+        all broadcast together. Shared by neighborhoods and nms, so they agree exactly. """
     y_diff = y - y_mu
     x_diff = x - x_mu
     if circular_x:
@@ -31,12 +37,60 @@ def neighborhoods(mu, x_range, y_range, sigma, circular_x=True, gaussian=False):
     if gaussian:
         output = torch.exp(-0.5 * ((x_diff/sigma)**2 + (y_diff/sigma)**2 ))
     else:
-        output = torch.logical_and(torch.abs(x_diff) <= sigma, torch.abs(y_diff) <= sigma).type(mu.dtype)
+        output = torch.logical_and(torch.abs(x_diff) <= sigma, torch.abs(y_diff) <= sigma).type(x_diff.dtype)
     return output
 
 
+def top_bins(flat_pred, k):
+    ''' Indices of the k largest of each row of non-negative (B, N) values, of equal values
+        the lowest indices '''
+    if flat_pred.dtype == torch.float64:
+        return torch.sort(flat_pred, dim=1, descending=True, stable=True)[1][:, :k]
+    # Non-negative floats order like their bits, so one int64 key holds value then index
+    n = flat_pred.shape[1]
+    bits = (flat_pred.float() + 0.0).view(torch.int32).long()
+    return torch.topk(bits*n - torch.arange(n, device=flat_pred.device), k, dim=1)[1]
+
+
 def nms(pred, max_predictions=10, sigma=1.0, gaussian=False):
-    ''' Input (batch_size, 1, height, width) '''
+    ''' Input (batch_size, 1, height, width), non-negative. Same results as greedy_nms,
+        which selects the largest remaining bin and suppresses its neighborhood
+        max_predictions times. Also a loop of max_predictions steps, but each only works
+        on the k largest bins of each grid, ties broken by grid order, and nothing waits
+        on the device. Each selection suppresses at most (2r+1)^2 bins of the box mask,
+        so some candidate is never suppressed, and no bin left out can be larger or as
+        large with a lower index. The gaussian mask suppresses every bin a little, so
+        none can be left out and it runs greedy_nms. '''
+
+    if gaussian:
+        return greedy_nms(pred, max_predictions, sigma, gaussian)
+    shape = pred.shape
+    width = shape[-1]
+    flat_pred = pred.reshape((shape[0], -1))
+    n_bins = flat_pred.shape[1]
+    r = int(math.floor(sigma))
+    k = min(n_bins, (2*r + 1)**2*(max_predictions - 1) + 1)
+    # In grid order, so ties select the lowest index like greedy_nms
+    candidates, _ = torch.sort(top_bins(flat_pred, k), dim=1)
+    supp_pred = flat_pred.gather(1, candidates)
+    x = (candidates % width).float()
+    y = (candidates // width).float()
+    rows = torch.arange(shape[0], device=pred.device)
+    selected = []
+    for i in range(max_predictions):
+        j = torch.argmax(supp_pred, dim=1)
+        selected.append(candidates[rows, j])
+        g = neighborhood_weights(x, y, x[rows, j].unsqueeze(1), y[rows, j].unsqueeze(1), width, sigma)
+        supp_pred *= (1-g)
+
+    ix = torch.stack(selected, dim=1)
+    output = torch.zeros_like(flat_pred).scatter_(1, ix, flat_pred.gather(1, ix))
+    return output.clamp_(min=0).reshape(shape)
+
+
+def greedy_nms(pred, max_predictions=10, sigma=1.0, gaussian=False):
+    ''' Input (batch_size, 1, height, width). Suppressing one prediction at a time over
+        the whole grid. Reference for nms. '''
 
     shape = pred.shape
     output = torch.zeros_like(pred)
@@ -51,7 +105,7 @@ def nms(pred, max_predictions=10, sigma=1.0, gaussian=False):
         flat_output[indices,ix] = flat_pred[indices,ix]
 
         # Suppression
-        y = ix / shape[-1]
+        y = ix // shape[-1]
         x = ix % shape[-1]
         mu = torch.stack([x,y], dim=1).float()
         g = neighborhoods(mu, shape[-1], shape[-2], sigma, gaussian=gaussian)
@@ -61,12 +115,14 @@ def nms(pred, max_predictions=10, sigma=1.0, gaussian=False):
     return output
 
 
-def eval_net(net, dataset, device, num_examples):
-    """Evaluation"""
+def eval_net(net, dataset, device, num_examples, loss_args={}):
+    """Evaluation. loss_args are passed on to SinkhornImageLoss, except any dual_cache,
+       so validation results do not depend on the potentials cached by earlier batches."""
     net.eval()
     val_loss = 0
     val_emd = 0
-    criterion = SinkhornImageLoss(reduction='none')
+    loss_args = {k: v for k, v in loss_args.items() if k != 'dual_cache'}
+    criterion = SinkhornImageLoss(reduction='none', device=device, **loss_args)
 
     dataset.reset_epoch()
     n_items = len(dataset.data)
@@ -82,11 +138,11 @@ def eval_net(net, dataset, device, num_examples):
             feats = torch.from_numpy(feats).to(device=device)
             true_masks = torch.from_numpy(true_masks).to(device=device)
 
-            masks_pred = net(scans,feats)
+            masks_pred = net(scans, feats, dataset.batch_feature_keys, dataset.batch_rotations)
             norm_pred = F.softmax(masks_pred.flatten(1), dim=1).reshape(masks_pred.shape)
             nms_pred = nms(norm_pred)
 
-            loss, emd = criterion(masks_pred, true_masks, compute_emd=True)
+            loss, emd = criterion(masks_pred, true_masks, compute_emd=True, long_ids=long_ids)
             keep = loss.shape[0] if i+1 < n_batches else last_batch_size
 
             if saved_ims < num_examples:
@@ -106,4 +162,5 @@ def eval_net(net, dataset, device, num_examples):
                 break
             val_loss += loss[:keep].sum().item()
             val_emd += emd[:keep].sum().item()
+    criterion.close()
     return val_loss/n_items, val_emd/n_items
@@ -0,0 +1,137 @@
+''' Export the UNet for deployment: traced TorchScript and ONNX models, and a post-training
+    static int8 quantized model for CPU inference, calibrated on DataLoader batches.
+    Also benchmarks latency, throughput and EMD of the int8 model against eager fp32. '''
+
+import os
+import copy
+import time
+import argparse
+import warnings
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from unet import UNet
+from loss import batch_emd
+from utils import radial_cost_matrix, RANGE_BINS, HEADING_BINS
+from features import FEATURE_SIZE
+
+
+def example_inputs(batch_size=1):
+    ''' Zero (scans, features) inputs of the shapes the model is traced with '''
+    return torch.zeros(batch_size, 2, RANGE_BINS, HEADING_BINS), torch.zeros(batch_size, FEATURE_SIZE, 3, 12)
+
+
+def export_torchscript(net, path):
+    ''' Trace the model, including its radial padding, and save it as TorchScript '''
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', torch.jit.TracerWarning)
+        traced = torch.jit.trace(net, example_inputs())
+    traced.save(path)
+    return traced
+
+
+def export_onnx(net, path, opset=13):
+    ''' Export the fp32 model to ONNX with a dynamic batch dimension. Needs the onnx package. '''
+    torch.onnx.export(net, example_inputs(), path, input_names=['scans', 'features'], output_names=['logits'],
+                      dynamic_axes={'scans': {0: 'batch'}, 'features': {0: 'batch'}, 'logits': {0: 'batch'}},
+                      opset_version=opset, dynamo=False)
+
+
+def loader_batches(loader, n_batches):
+    ''' (scans, features, targets) tensors of the next n_batches batches of a DataLoader '''
+    batches = []
+    for _ in range(n_batches):
+        scans, features, targets, _ = loader.get_batch()
+        batches.append((torch.from_numpy(scans), torch.from_numpy(features), torch.from_numpy(targets)))
+    return batches
+
+
+def quantize_int8(net, calibration, backend='x86'):
+    ''' Post-training static int8 quantization of an eval mode fp32 model, with activation
+        ranges observed on the calibration (scans, features, ...) batches. Returns a
+        model that takes and returns float tensors. '''
+    from torch.ao.quantization import get_default_qconfig_mapping
+    from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+
+    torch.backends.quantized.engine = backend
+    prepared = prepare_fx(copy.deepcopy(net).eval(), get_default_qconfig_mapping(backend), example_inputs())
+    with torch.no_grad():
+        for batch in calibration:
+            prepared(batch[0], batch[1])
+    return convert_fx(prepared)
+
+
+def benchmark(models, batches, latency_runs=50):
+    ''' Median batch size 1 latency, throughput at the batches' size and mean EMD to the
+        targets of each model, with its mean absolute EMD difference to the first model '''
+    cost = radial_cost_matrix()[0]
+    results = {}
+    reference = None
+    with torch.no_grad():
+        for name, model in models.items():
+            scans, features = batches[0][0][:1], batches[0][1][:1]
+            model(scans, features)
+            latencies = []
+            for _ in range(latency_runs):
+                start = time.time()
+                model(scans, features)
+                latencies.append(time.time() - start)
+            emd = []
+            start = time.time()
+            for scans, features, targets in batches:
+                logits = model(scans, features)
+                pred_probs = F.softmax(logits.flatten(1), dim=1).numpy()
+                emd.append(batch_emd(pred_probs, targets.flatten(1).numpy(), cost))
+            elapsed = time.time() - start
+            emd = np.concatenate(emd)
+            if reference is None:
+                reference = emd
+            results[name] = {
+                'latency_ms': 1000*float(np.median(latencies)),
+                'throughput': len(emd)/elapsed,
+                'emd': float(emd.mean()),
+                'emd_delta': float(np.abs(emd - reference).mean()),
+            }
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Export the UNet to TorchScript, ONNX and int8 TorchScript')
+    parser.add_argument('-f', '--load', dest='load', type=str, required=True, help='Load model from a .pth file')
+    parser.add_argument('-o', '--output', default='exports/unet', help='Output path prefix')
+    parser.add_argument('-b', '--batch-size', dest='batch_size', type=int, default=32,
+                        help='Batch size of calibration and benchmark batches')
+    parser.add_argument('-cb', '--calibration-batches', dest='calibration_batches', type=int, default=10)
+    parser.add_argument('-eb', '--eval-batches', dest='eval_batches', type=int, default=10,
+                        help='Batches, after the calibration batches, to benchmark on')
+    parser.add_argument('--backend', default='x86', help='Quantized engine, e.g. x86 or qnnpack for ARM')
+    args = parser.parse_args()
+
+    from dataloader import DataLoader
+    from features import load_img_features, FeatureTable
+
+    net = UNet(n_channels=2, n_classes=1, ch=64)
+    net.load_state_dict(torch.load(args.load, map_location='cpu'))
+    net.eval()
+    os.makedirs(os.path.dirname(args.output) or '.', exist_ok=True)
+
+    traced = export_torchscript(net, args.output + '.pt')
+    print('Saved TorchScript model to %s.pt' % args.output)
+    try:
+        export_onnx(net, args.output + '.onnx')
+        print('Saved ONNX model to %s.onnx' % args.output)
+    except Exception as e:
+        print('Skipped ONNX export: %s' % e)
+
+    # Calibrate and benchmark on disjoint batches of the validation set
+    val = DataLoader(FeatureTable(load_img_features(splits=['val'])), splits=['val'], bs=args.batch_size)
+    quantized = quantize_int8(net, loader_batches(val, args.calibration_batches), args.backend)
+    traced_int8 = export_torchscript(quantized, args.output + '_int8.pt')
+    print('Saved int8 TorchScript model to %s_int8.pt' % args.output)
+
+    models = {'fp32': net, 'fp32 torchscript': traced, 'int8': quantized, 'int8 torchscript': traced_int8}
+    results = benchmark(models, loader_batches(val, args.eval_batches))
+    print('model             latency (ms)  throughput (/s)  EMD (m)  EMD delta (m)')
+    for name, r in results.items():
+        print('%-16s  %12.2f  %15.1f  %7.3f  %13.4f' % (name, r['latency_ms'], r['throughput'], r['emd'], r['emd_delta']))
@@ -0,0 +1,166 @@
+''' Packed binary store for the precomputed ResNet-152 image features. The TSV
+    features are converted once into a single (rows, 36, 2048) float32 .npy
+    file plus a json index from long_id to rows. Reading memory maps the array,
+    so every process shares the same page cache and startup is near instant. '''
+
+import os
+import sys
+import csv
+import json
+import time
+import base64
+import argparse
+import numpy as np
+
+from collections import defaultdict
+
+from utils import read_img_features, load_scenes, IMAGENET_FEATURES
+
+VIEWS = 36
+FEATURE_SIZE = 2048
+TSV_FIELDNAMES = ['scanId', 'viewpointId', 'image_w', 'image_h', 'vfov', 'features']
+FEATURE_STORE = '../Matterport3DSimulator/img_features/ResNet-152-imagenet'
+
+
+def store_paths(store=FEATURE_STORE):
+    ''' Paths of the packed feature array and its long_id index '''
+    return store + '.npy', store + '.index.json'
+
+
+def count_rows(path, chunk_size=1<<24):
+    ''' Count the lines in a file without parsing it '''
+    rows = 0
+    last = b'\n'
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            rows += chunk.count(b'\n')
+            last = chunk[-1:]
+    # Final line may not be newline terminated
+    return rows if last == b'\n' else rows + 1
+
+
+def convert_img_features(feature_stores=IMAGENET_FEATURES, store=FEATURE_STORE):
+    ''' One-time conversion of TSV feature files to a packed binary store. Rows
+        from every TSV are stacked, so a long_id has one row per feature file. '''
+    from tqdm import tqdm
+    csv.field_size_limit(sys.maxsize)
+
+    n_rows = sum(count_rows(path) for path in feature_stores)
+    data_path, index_path = store_paths(store)
+    tmp_path = data_path + '.tmp'
+    data = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.float32,
+                                     shape=(n_rows, VIEWS, FEATURE_SIZE))
+    index = defaultdict(list)
+    row = 0
+    start = time.time()
+    for feature_store in feature_stores:
+        print("Converting image features from %s" % feature_store)
+        with open(feature_store, "r") as tsv_in_file:
+            reader = csv.DictReader(tsv_in_file, delimiter='\t', fieldnames=TSV_FIELDNAMES)
+            for item in tqdm(reader):
+                long_id = item['scanId'] + "_" + item['viewpointId']
+                data[row] = np.frombuffer(base64.b64decode(item['features']),
+                                          dtype=np.float32).reshape((VIEWS, FEATURE_SIZE))
+                index[long_id].append(row)
+                row += 1
+    data.flush()
+    del data
+    assert row == n_rows, 'Expected %d rows but decoded %d' % (n_rows, row)
+
+    # Rename into place last so readers never see a partial store
+    with open(index_path + '.tmp', 'w') as f:
+        json.dump({'feature_stores': feature_stores, 'shape': [n_rows, VIEWS, FEATURE_SIZE], 'rows': index}, f)
+    os.replace(index_path + '.tmp', index_path)
+    os.replace(tmp_path, data_path)
+    print("Wrote %d feature rows to %s in %0.4f seconds" % (n_rows, data_path, time.time() - start))
+
+
+class FeatureStore(defaultdict):
+    """ read_img_feature_store's long_id -> feature versions mapping. Also keeps the memory
+        mapped (rows, 36, 2048) store and the rows of each long_id, so a FeatureTable
+        can share the store instead of copying it. """
+
+    def __init__(self, data, rows):
+        super(FeatureStore, self).__init__(list)
+        self.data = data
+        self.rows = rows
+        for long_id, long_id_rows in rows.items():
+            self[long_id] = [data[row] for row in long_id_rows]
+
+
+def read_img_feature_store(store=FEATURE_STORE, splits=None):
+    ''' Load the packed feature store. Returns the same long_id -> list of (36, 2048)
+        arrays mapping as read_img_features, but every array is a read-only
+        zero-copy view into the memory mapped file. '''
+    scenes = set(load_scenes(splits)) if splits is not None else None
+    start = time.time()
+    data_path, index_path = store_paths(store)
+    data = np.load(data_path, mmap_mode='r')
+    with open(index_path) as f:
+        index = json.load(f)
+    assert list(data.shape) == index['shape'], 'Feature store %s does not match its index' % data_path
+    rows = {long_id: long_id_rows for long_id, long_id_rows in index['rows'].items()
+            if scenes is None or long_id.split('_')[0] in scenes}
+    features = FeatureStore(data, rows)
+    print("Mapped %d image features from %s in %0.4f seconds" % (len(features), data_path, time.time() - start))
+    return features
+
+
+class FeatureTable:
+    """ Every feature version of every long_id in one (rows, 3, 12, 2048) array of 12 near
+        range views, 12 medium range views and 12 ceiling views. One table can be shared
+        by several DataLoaders, which refer to their features by row. A FeatureStore of
+        the same dtype is used in place, so processes share its page cache, otherwise
+        the features are copied in. Use dtype=np.float16 to halve the memory of a copy,
+        batches are upcast to float32. """
+
+    # Views are rolled by 6 in gather, so zero heading is in the middle
+    # (although actually out by 0.5 grid cells)
+    VIEW_ROLL = 6
+
+    def __init__(self, features, dtype=np.float32):
+        if isinstance(features, FeatureStore) and features.data.dtype == dtype:
+            self.data = features.data.reshape(-1, 3, 12, FEATURE_SIZE)
+            self.rows = dict(features.rows)
+            return
+        n_rows = sum(len(versions) for versions in features.values())
+        self.data = np.empty((n_rows, 3, 12, FEATURE_SIZE), dtype=dtype)
+        self.rows = {}
+        row = 0
+        for long_id, versions in features.items():
+            self.rows[long_id] = list(range(row, row+len(versions)))
+            for feature_version in versions:
+                self.data[row] = feature_version.reshape(3,12,FEATURE_SIZE)
+                row += 1
+
+    def gather(self, rows, rotations=None, dtype=np.float32):
+        ''' Features of the given rows as a (B, 2048, 3, 12) batch, rolled so zero heading
+            is in the middle and then by rotations[n] views if given '''
+        rows = np.asarray(rows)
+        n_levels, n_views = self.data.shape[1:3]
+        roll = self.VIEW_ROLL
+        if rotations is not None:
+            roll = roll + np.asarray(rotations)[:, None, None]
+        views = (np.arange(n_views)[None, None, :] - roll) % n_views
+        # gather whole rows of 2048 features
+        ix = (rows[:, None, None]*n_levels + np.arange(n_levels)[None, :, None])*n_views + views
+        feats = self.data.reshape(-1, self.data.shape[-1])[ix.reshape(-1)].reshape(len(rows), n_levels, n_views, -1)
+        return np.ascontiguousarray(feats.transpose((0,3,1,2)), dtype=dtype)
+
+
+def load_img_features(splits=None, store=FEATURE_STORE, feature_stores=IMAGENET_FEATURES):
+    ''' Use the packed feature store if it has been generated, otherwise parse the TSVs.
+        Only features for scans in the given splits are loaded (all if None). '''
+    if os.path.exists(store_paths(store)[0]):
+        return read_img_feature_store(store, splits)
+    return read_img_features(feature_stores, splits)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Convert TSV image features to a packed binary store')
+    parser.add_argument('-i', '--input', nargs='+', default=IMAGENET_FEATURES,
+                        help='TSV feature files', dest='feature_stores')
+    parser.add_argument('-o', '--output', default=FEATURE_STORE,
+                        help='Output path prefix of the feature store', dest='store')
+    args = parser.parse_args()
+    convert_img_features(args.feature_stores, args.store)
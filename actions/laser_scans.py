@@ -0,0 +1,158 @@
+''' Compact binary format for the generated laser scans. A laser_scans.bin file
+    is a 64 byte header followed by fixed size little-endian records, one per
+    viewpoint:
+
+        image_id    32 bytes, ascii, null padded
+        position    3 x float64 (x, y, z in meters)
+        laser       N x uint16 ranges in millimeters, NO_RETURN for missing returns
+
+    Records are appended as they are generated, so the scan generation job can
+    stream into the file and readers can load it with a single np.fromfile. '''
+
+import os
+import json
+import argparse
+import numpy as np
+
+MAGIC = b'LASERSCN'
+VERSION = 1
+HEADER_SIZE = 64
+ID_SIZE = 32
+NO_RETURN = 65535 # Sentinel for the -1 no return value
+MAX_RANGE_MM = NO_RETURN - 1
+LASER_SCANS_JSON = 'laser_scans.json'
+LASER_SCANS_BIN = 'laser_scans.bin'
+
+
+def record_dtype(n_values):
+    return np.dtype([('image_id', 'S%d' % ID_SIZE), ('position', '<f8', (3,)), ('laser', '<u2', (n_values,))])
+
+
+def encode_laser(laser):
+    ''' Encode ranges in meters (-1 for no return) as uint16 millimeters '''
+    laser = np.asarray(laser, dtype=np.float64)
+    # Round half up, matching Math.round in LaserScan.js
+    mm = np.clip(np.floor(laser*1000 + 0.5), 0, MAX_RANGE_MM).astype(np.uint16)
+    mm[laser < 0] = NO_RETURN
+    return mm
+
+
+def decode_laser(mm):
+    ''' Decode uint16 millimeters to float64 ranges in meters, -1 for no return '''
+    laser = mm.astype(np.float64)/1000
+    laser[mm == NO_RETURN] = -1
+    return laser
+
+
+class LaserScanWriter:
+    """ Streaming writer for laser_scans.bin files """
+
+    def __init__(self, path, scan, n_values=1440):
+        assert len(scan.encode('ascii')) <= HEADER_SIZE - 20
+        self.scan = scan
+        self.n_values = n_values
+        self.dtype = record_dtype(n_values)
+        self.f = open(path, 'wb')
+        header = np.zeros(HEADER_SIZE, dtype=np.uint8)
+        header[:8] = np.frombuffer(MAGIC, dtype=np.uint8)
+        header[8:20] = np.array([VERSION, n_values, ID_SIZE], dtype='<u4').view(np.uint8)
+        header[20:20+len(scan)] = np.frombuffer(scan.encode('ascii'), dtype=np.uint8)
+        self.f.write(header.tobytes())
+
+    def write(self, image_id, position, laser):
+        ''' Append one viewpoint. position is a dict with x, y, z keys. '''
+        assert len(laser) == self.n_values
+        record = np.zeros(1, dtype=self.dtype)
+        record['image_id'] = image_id.encode('ascii')
+        record['position'] = [position['x'], position['y'], position['z']]
+        record['laser'] = encode_laser(laser)
+        self.f.write(record.tobytes())
+
+    def close(self):
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def read_header(f):
+    header = f.read(HEADER_SIZE)
+    assert header[:8] == MAGIC, 'Not a laser scan file'
+    version, n_values, id_size = np.frombuffer(header[8:20], dtype='<u4')
+    assert version == VERSION and id_size == ID_SIZE, 'Unsupported laser scan file version'
+    scan = header[20:].rstrip(b'\0').decode('ascii')
+    return scan, int(n_values)
+
+
+def read_laser_records(path):
+    ''' Read a laser_scans.bin file as (scan, structured record array). A
+        partially written final record is ignored. '''
+    with open(path, 'rb') as f:
+        scan, n_values = read_header(f)
+        dtype = record_dtype(n_values)
+        n_records = (os.path.getsize(path) - HEADER_SIZE)//dtype.itemsize
+        records = np.fromfile(f, dtype=dtype, count=n_records)
+    return scan, records
+
+
+def read_laser_scans(path):
+    ''' Read a laser_scans.bin file into the same list of items as the json
+        (image_id, position, scan, laser), with laser as a float64 array. '''
+    scan, records = read_laser_records(path)
+    lasers = decode_laser(records['laser'])
+    items = []
+    for record, laser in zip(records, lasers):
+        x, y, z = record['position']
+        items.append({
+            'image_id': record['image_id'].decode('ascii'),
+            'position': {'x': float(x), 'y': float(y), 'z': float(z)},
+            'scan': scan,
+            'laser': laser,
+        })
+    return items
+
+
+def laser_scans_path(scene_dir):
+    ''' Path of the laser scans for a scene, preferring the binary format '''
+    bin_path = os.path.join(scene_dir, LASER_SCANS_BIN)
+    if os.path.exists(bin_path):
+        return bin_path
+    return os.path.join(scene_dir, LASER_SCANS_JSON)
+
+
+def load_laser_scans(scene_dir):
+    ''' Load the laser scans for a scene from whichever format is available '''
+    path = laser_scans_path(scene_dir)
+    if path.endswith('.bin'):
+        return read_laser_scans(path)
+    with open(path) as jf:
+        return json.load(jf)
+
+
+def convert_laser_scans(json_path, bin_path):
+    ''' Convert a laser_scans.json file to the binary format '''
+    with open(json_path) as jf:
+        json_data = json.load(jf)
+    assert json_data, 'No laser scans in %s' % json_path
+    tmp_path = bin_path + '.tmp'
+    with LaserScanWriter(tmp_path, json_data[0]['scan'], len(json_data[0]['laser'])) as writer:
+        for item in json_data:
+            writer.write(item['image_id'], item['position'], item['laser'])
+    os.replace(tmp_path, bin_path)
+    return len(json_data)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Convert laser_scans.json files to the binary laser scan format')
+    parser.add_argument('-d', '--data-dir', default='data/', dest='data_dir',
+                        help='Matterport data directory containing one directory per scan')
+    args = parser.parse_args()
+
+    for scene in sorted(os.listdir(args.data_dir)):
+        json_path = os.path.join(args.data_dir, scene, LASER_SCANS_JSON)
+        if os.path.exists(json_path):
+            n = convert_laser_scans(json_path, os.path.join(args.data_dir, scene, LASER_SCANS_BIN))
+            print('Converted %d laser scans for %s' % (n, scene))
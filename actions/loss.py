@@ -1,37 +1,257 @@
+import time
+import argparse
 import torch
 import torch.nn as nn
 import ot
 import numpy as np
 
+from collections import OrderedDict
+
 from utils import radial_cost_matrix
+from sinkhorn import SinkhornOT
 
 class SinkhornImageLoss(nn.Module):
+    """ Sinkhorn loss between predicted logits and target distributions over the radial grid.
+        Set chunk_size to compute Sinkhorn in O(B*N) memory, see SinkhornDistance.
+
+        With sparse_targets, the target side of the transport problem is restricted to
+        the support of each target (padded to the largest support in the batch), so
+        each iteration works on a (B, N, k) cost instead of (B, N, N). Run to convergence
+        the sparse and dense losses agree to within 1e-3 (see the sparse target test and
+        benchmark_solvers). With the default 10 iterations neither has converged, but the
+        sparse problem gets much closer, so its loss is larger than the dense loss, e.g.
+        1.5 against 0.9 on random predictions and targets. With eps_start=1.0 annealing
+        they agree to 1e-3 even at 10 iterations.
+
+        Set implicit to use the entropic dual objective of the final potentials as the
+        loss and backpropagate from them instead of through every iteration, and check_every to control how often convergence is checked,
+        see SinkhornDistance. Pass a DualCache, and the batch long_ids to forward, to warm
+        start the iterations from the potentials of the last visit to each example (which
+        changes the loss unless the iterations converge, see DualCache), and eps_start to
+        anneal the regularization.
+
+        backend='sinkstep' instead solves with sinkhorn.SinkhornOT, which runs max_iter
+        batched sinkstep iterations (the CUDA kernel for CUDA tensors, when it can be
+        built) and backpropagates from its final potentials. It ignores the other solver
+        options. Its loss is not comparable to the default backend's unless both have
+        converged: at the default 10 iterations it is about 2.1 on random predictions and
+        targets, against about 0.9 for the default solver, which only reaches about 2.2
+        after 100 iterations.
 
-    def __init__(self, reduction='mean'):
+        The exact EMD (compute_emd) is solved between the bins with mass only, see
+        batch_emd, over a pool of emd_workers processes if set. Call close() to shut
+        the pool down. """
+
+    def __init__(self, reduction='mean', device='cuda', chunk_size=None, sparse_targets=False,
+                 max_iter=10, implicit=False, check_every=1, dual_cache=None, eps_start=None,
+                 backend='sinkhorn', emd_workers=0):
         super(SinkhornImageLoss, self).__init__()
         self.logsoftmax = nn.LogSoftmax(dim=1)
         self.softmax = nn.Softmax(dim=1)
-        self.C = torch.from_numpy(radial_cost_matrix()).float().cuda()
-        self.criterion = SinkhornDistance(self.C, reduction=reduction)
+        self.C = torch.from_numpy(radial_cost_matrix()).float().to(device)
+        self.sparse_targets = sparse_targets
+        self.dual_cache = dual_cache
+        assert backend in ['sinkhorn', 'sinkstep'], 'Unknown Sinkhorn backend %s' % backend
+        self.backend = backend
+        self.emd_workers = emd_workers
+        self.emd_pool = None
+        self.criterion = SinkhornDistance(self.C, max_iter=max_iter, reduction=reduction,
+                                          chunk_size=chunk_size, implicit=implicit,
+                                          check_every=check_every, eps_start=eps_start)
 
-    def forward(self, pred_logits, target_probs, compute_emd=False):
+    def forward(self, pred_logits, target_probs, compute_emd=False, long_ids=None):
         # Predicted logits and target probabilities shaped (N, 1, H, W)
         batch_size = pred_logits.shape[0]
         pred_logp = self.logsoftmax(pred_logits.flatten(1))
-        target_logp = torch.log(target_probs+1e-8).reshape(batch_size, -1)
-        loss, P = self.criterion(pred_logp, target_logp)
+        flat_targets = target_probs.reshape(batch_size, -1)
+        warm_start = self.backend == 'sinkhorn' and self.dual_cache is not None and long_ids is not None
+        v0 = self.dual_cache.lookup(long_ids, target_probs) if warm_start else None
+        if self.backend == 'sinkstep':
+            loss, P = self.sinkstep_loss(pred_logits, flat_targets), None
+        elif self.sparse_targets:
+            target_logp, C, support = self.target_support(flat_targets)
+            if warm_start:
+                v0 = torch.gather(v0, 1, support)
+            loss, P = self.criterion(pred_logp, target_logp, C, v0=v0)
+        else:
+            target_logp = torch.log(target_probs+1e-8).reshape(batch_size, -1)
+            loss, P = self.criterion(pred_logp, target_logp, v0=v0)
+        if warm_start:
+            v = self.criterion.potentials[1]
+            if self.sparse_targets:
+                v = torch.zeros_like(flat_targets).scatter_(1, support, v)
+            self.dual_cache.update(long_ids, target_probs, v)
 
         if compute_emd:
-            emd = np.zeros(batch_size)
             pred_probs = self.softmax(pred_logits.flatten(1)).cpu().numpy()
             target_probs = target_probs.flatten(1).cpu().numpy()
-            cost = self.C[0].cpu().numpy()
-            for n in range(batch_size): 
-              emd[n] = ot.emd2(pred_probs[n], target_probs[n], cost)
+            if self.emd_workers and self.emd_pool is None:
+                from multiprocessing import Pool
+                self.emd_pool = Pool(self.emd_workers)
+            emd = batch_emd(pred_probs, target_probs, self.C[0].cpu().numpy(), self.emd_pool)
         else:
             emd = None
         return loss, emd
 
+    def target_support(self, target_probs):
+        """ Restrict (B, N) target probabilities to their k non-zero bins. Returns (B, k)
+            log probabilities, the (B, N, k) cost from every bin to those bins and the
+            (B, k) bin indices. Padding bins get the same 1e-8 floor as the dense loss. """
+        k = int((target_probs > 0).sum(dim=1).max())
+        probs, support = torch.topk(target_probs, k, dim=1)
+        target_logp = torch.log(torch.clamp(probs, min=1e-8))
+        C = self.C[0][:, support].permute(1, 0, 2)
+        return target_logp, C, support
+
+    def sinkstep_loss(self, pred_logits, target_probs):
+        "Sinkhorn loss from SinkhornOT for (B, N) target probabilities"
+        criterion = self.criterion
+        loss = SinkhornOT.apply(self.softmax(pred_logits.flatten(1)), target_probs, self.C[0],
+                                criterion.eps, criterion.max_iter)
+        criterion.iterations = torch.full_like(loss, criterion.max_iter, dtype=torch.long)
+        if criterion.reduction == 'mean':
+            return loss.mean()
+        elif criterion.reduction == 'sum':
+            return loss.sum()
+        return loss
+
+    def close(self):
+        "Shut down the EMD worker pool, if any"
+        if self.emd_pool is not None:
+            self.emd_pool.close()
+            self.emd_pool.join()
+            self.emd_pool = None
+
+    @property
+    def iterations(self):
+        "Sinkhorn iterations used by each sample in the last call"
+        return self.criterion.iterations
+
+
+
+def _emd2(problem):
+    return ot.emd2(*problem)
+
+
+def batch_emd(pred_probs, target_probs, cost, pool=None):
+    ''' Exact EMD between each row of (B, N) pred_probs and target_probs, in parallel if a
+        multiprocessing pool is given. Bins without mass carry no flow, so each problem
+        is only solved between the bins with mass, which for a target is a handful.
+        Only the reduced costs are sent to the workers. '''
+    problems = []
+    for pred, target in zip(pred_probs, target_probs):
+        src = np.flatnonzero(pred)
+        dst = np.flatnonzero(target)
+        problems.append((pred[src], target[dst], cost[np.ix_(src, dst)]))
+    emd = pool.map(_emd2, problems) if pool is not None else map(_emd2, problems)
+    return np.array(list(emd), dtype=np.float64)
+
+
+class DualCache:
+    """ LRU cache of the target side Sinkhorn potential v of up to max_entries examples,
+        keyed by long_id, to warm start the next loss on the same example. With
+        rotation augmentation an example's target changes between visits, so each
+        entry keeps its target and lookup rolls the cached potential by whichever
+        heading shift maps the cached target onto the new one. Examples with no
+        matching entry start from zero. Any start converges to the same solution, but
+        the loss is only independent of the start once the iterations converge, i.e.
+        with max_iter large enough that every example stops at the error threshold.
+        At the default 10 iterations a warm start changes the loss value itself, so
+        evaluation runs without a cache. """
+
+    def __init__(self, max_entries=50000):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def lookup(self, long_ids, target_probs):
+        ''' Warm start (B, H*W) potentials for a batch of (B, 1, H, W) targets '''
+        v0 = torch.zeros_like(target_probs)
+        hits = [n for n, long_id in enumerate(long_ids[:v0.shape[0]]) if long_id in self.entries]
+        if not hits:
+            return v0.flatten(1)
+        cached = torch.zeros_like(target_probs)
+        for n in hits:
+            self.entries.move_to_end(long_ids[n])
+            cached[n], v0[n] = self.entries[long_ids[n]]
+        # Compare the new targets with every heading roll of the cached targets
+        width = target_probs.shape[-1]
+        rolled = torch.stack([cached.roll(s, dims=-1) for s in range(width)], dim=1)
+        match = (rolled == target_probs.unsqueeze(1)).flatten(2).all(-1)
+        shift = match.float().argmax(dim=1)
+        v0 = torch.stack([v0.roll(s, dims=-1) for s in range(width)], dim=1)
+        v0 = v0[torch.arange(v0.shape[0], device=v0.device), shift]
+        return torch.where(match.any(dim=1).view(-1, 1, 1, 1), v0, torch.zeros_like(v0)).flatten(1)
+
+    def update(self, long_ids, target_probs, v):
+        ''' Store the (B, H*W) potentials v solved for a batch of (B, 1, H, W) targets '''
+        v = v.detach().reshape(target_probs.shape)
+        for n, long_id in enumerate(long_ids[:v.shape[0]]):
+            self.entries[long_id] = (target_probs[n].detach().clone(), v[n].clone())
+            self.entries.move_to_end(long_id)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+
+class LogSumExpMatVec(torch.autograd.Function):
+    """ out[b, i] = logsumexp_j((x[b, j] - C[i, j]) / eps), computed over chunks of rows
+        of C. Forward and backward only ever hold a (B, chunk_size, M) temporary, and
+        only x and out are saved for backward, so memory is O(B*N) not O(B*N*M). """
+
+    @staticmethod
+    def forward(ctx, x, C, eps, chunk_size):
+        out = x.new_empty((x.shape[0], C.shape[0]))
+        for s in range(0, C.shape[0], chunk_size):
+            out[:, s:s+chunk_size] = torch.logsumexp((x.unsqueeze(1) - C[s:s+chunk_size].unsqueeze(0)) / eps, dim=-1)
+        ctx.save_for_backward(x, C, out)
+        ctx.eps = eps
+        ctx.chunk_size = chunk_size
+        return out
+
+    @staticmethod
+    def backward(ctx, grad_out):
+        x, C, out = ctx.saved_tensors
+        eps, chunk_size = ctx.eps, ctx.chunk_size
+        grad_x = torch.zeros_like(x)
+        for s in range(0, C.shape[0], chunk_size):
+            # Softmax over j of each row, weighted by the incoming gradient of that row
+            p = torch.exp((x.unsqueeze(1) - C[s:s+chunk_size].unsqueeze(0)) / eps - out[:, s:s+chunk_size].unsqueeze(-1))
+            grad_x += torch.einsum('bi,bij->bj', grad_out[:, s:s+chunk_size], p) / eps
+        return grad_x, None, None, None
+
+
+class TransportCost(torch.autograd.Function):
+    """ cost[b] = sum_ij pi[b, i, j] * C[i, j] for the transport plan
+        pi = exp((u_i + v_j - C_ij) / eps), computed over chunks of rows of C
+        without materializing pi. """
+
+    @staticmethod
+    def forward(ctx, u, v, C, eps, chunk_size):
+        cost = u.new_zeros(u.shape[0])
+        for s in range(0, C.shape[0], chunk_size):
+            Cs = C[s:s+chunk_size].unsqueeze(0)
+            pi = torch.exp((u[:, s:s+chunk_size].unsqueeze(-1) + v.unsqueeze(1) - Cs) / eps)
+            cost += torch.sum(pi * Cs, dim=(-2, -1))
+        ctx.save_for_backward(u, v, C)
+        ctx.eps = eps
+        ctx.chunk_size = chunk_size
+        return cost
+
+    @staticmethod
+    def backward(ctx, grad_cost):
+        u, v, C = ctx.saved_tensors
+        eps, chunk_size = ctx.eps, ctx.chunk_size
+        grad_u = torch.empty_like(u)
+        grad_v = torch.zeros_like(v)
+        for s in range(0, C.shape[0], chunk_size):
+            Cs = C[s:s+chunk_size].unsqueeze(0)
+            piC = torch.exp((u[:, s:s+chunk_size].unsqueeze(-1) + v.unsqueeze(1) - Cs) / eps) * Cs / eps
+            grad_u[:, s:s+chunk_size] = piC.sum(-1)
+            grad_v += piC.sum(1)
+        grad_cost = grad_cost.unsqueeze(-1)
+        return grad_cost * grad_u, grad_cost * grad_v, None, None, None
 
 
 # Adapted from https://github.com/gpeyre/SinkhornAutoDiff
@@ -47,61 +267,209 @@ class SinkhornDistance(nn.Module):
             'none' | 'mean' | 'sum'. 'none': no reduction will be applied,
             'mean': the sum of the output will be divided by the number of
             elements in the output, 'sum': the output will be summed. Default: 'none'
+        chunk_size (int, optional): if set, log-sum-exps and the transport cost are
+            computed over chunks of this many rows of C, and the (N, H, W) modified
+            cost and transport plan are never materialized. Memory is then O(N*H)
+            instead of O(N*H*W) and the returned plan is None. Default: None
+        implicit (bool, optional): if set, the iterations run without autograd and the
+            loss is the entropic dual objective of the final potentials (see
+            dual_objective) instead of the transport cost. With the potentials held
+            fixed its gradient is u for mu and v for nu, so backward memory and time do
+            not grow with max_iter. At convergence the dual equals <pi,C> - eps*H(pi),
+            and its gradient is that of the converged entropic OT loss (the envelope
+            theorem). The returned plan is detached. Default: False
+        check_every (int, optional): each sample stops updating once it converges, but
+            the loop only checks whether every sample has converged (a host-device
+            synchronization) every check_every iterations. With 0 it never checks and
+            always runs max_iter iterations. After each call, iterations holds the
+            number of iterations each sample used. Default: 1
+        eps_start (float, optional): if set, first anneal the regularization from eps_start
+            down towards eps, multiplying it by eps_decay each stage and running
+            anneal_iter iterations per stage, then iterate at eps as usual. The large
+            eps stages converge quickly and give the final stage a good start, so it
+            needs far fewer iterations. Default: None
+        eps_decay (float, optional): Default: 0.5
+        anneal_iter (int, optional): Default: 3
+        thresh (float, optional): a sample has converged once an iteration changes its
+            u by less than thresh (L1 norm). Default: 1e-1
 
     Shape:
         Input: (N, H, W) log probabilities
     """
-    def __init__(self, C, eps=0.01, max_iter=10, reduction='mean'):
+    def __init__(self, C, eps=0.01, max_iter=10, reduction='mean', chunk_size=None, implicit=False,
+                 check_every=1, eps_start=None, eps_decay=0.5, anneal_iter=3, thresh=1e-1):
         super(SinkhornDistance, self).__init__()
         self.eps = eps
         self.max_iter = max_iter
         self.reduction = reduction
         self.C = C
+        self.chunk_size = chunk_size
+        self.implicit = implicit
+        self.check_every = check_every
+        self.eps_start = eps_start
+        self.eps_decay = eps_decay
+        self.anneal_iter = anneal_iter
+        self.thresh = thresh
+        self.iterations = None
+        self.potentials = None
+        if chunk_size is not None:
+            self.Ct = C[0].t().contiguous()
 
-    def forward(self, mu_logp, nu_logp):
+    def forward(self, mu_logp, nu_logp, C=None, v0=None):
+        """ Optionally takes a (N, H, W) cost C to use instead of the module's cost,
+            e.g. when the target side is restricted to a per sample support, and
+            initial target side potentials v0 shaped like nu_logp. The final
+            potentials are kept in self.potentials. """
 
-        assert mu_logp.shape == nu_logp.shape
+        chunked = self.chunk_size is not None and C is None
+        if C is None:
+            C = self.C
+            assert mu_logp.shape == nu_logp.shape
         assert len(mu_logp.shape) == 2
-        batch_size = mu_logp.shape[0]
-        num_points =  mu_logp.shape[1]
 
+        if self.implicit:
+            with torch.no_grad():
+                u, v = self.iterate(mu_logp, nu_logp, C, chunked, v0)
+                pi = None if chunked else torch.exp(self.M(C, u, v))
+            cost = self.dual_objective(mu_logp, nu_logp, C, u, v, chunked)
+        else:
+            u, v = self.iterate(mu_logp, nu_logp, C, chunked, v0)
+            cost, pi = self.transport_cost(C, u, v, chunked)
+        self.potentials = (u.detach(), v.detach())
+
+        if self.reduction == 'mean':
+            cost = cost.mean()
+        elif self.reduction == 'sum':
+            cost = cost.sum()
+
+        return cost, pi
+
+    def iterate(self, mu_logp, nu_logp, C, chunked=False, v0=None):
+        """ Sinkhorn iterations from potentials v0 (zero if None), returns the dual
+            potentials u, v. Each sample stops updating once its change in u is below
+            the threshold, and self.iterations records how many iterations each used. """
         u = torch.zeros_like(mu_logp)
-        v = torch.zeros_like(nu_logp)
-        # To check if algorithm terminates because of threshold
-        # or max iterations reached
-        actual_nits = 0
-        # Stopping criterion
-        thresh = 1e-1
+        v = torch.zeros_like(nu_logp) if v0 is None else v0
+        # Epsilon annealing
+        schedule = self.eps_schedule()
+        for eps in schedule:
+            for i in range(self.anneal_iter):
+                u = eps * (mu_logp - self.lse_rows(C, u, v, chunked, eps)) + u
+                v = eps * (nu_logp - self.lse_cols(C, u, v, chunked, eps)) + v
+        # Samples still iterating, and the iterations each has used
+        active = torch.ones(mu_logp.shape[0], dtype=torch.bool, device=mu_logp.device)
+        iterations = torch.full((mu_logp.shape[0],), len(schedule)*self.anneal_iter,
+                                dtype=torch.long, device=mu_logp.device)
 
         # Sinkhorn iterations
         for i in range(self.max_iter):
             u1 = u  # useful to check the update
-            u = self.eps * (mu_logp - torch.logsumexp(self.M(self.C, u, v), dim=-1)) + u
-            v = self.eps * (nu_logp - torch.logsumexp(self.M(self.C, u, v).transpose(-2, -1), dim=-1)) + v
-            err = (u - u1).abs().sum(-1).mean()
-            actual_nits += 1
-            if err.item() < thresh:
+            u = self.eps * (mu_logp - self.lse_rows(C, u1, v, chunked)) + u1
+            v1 = v
+            v = self.eps * (nu_logp - self.lse_cols(C, u, v1, chunked)) + v1
+            err = (u - u1).abs().sum(-1)
+            # Converged samples keep their potentials
+            u = torch.where(active.unsqueeze(-1), u, u1)
+            v = torch.where(active.unsqueeze(-1), v, v1)
+            iterations += active
+            active = active & (err >= self.thresh)
+            # Checking for convergence waits for the device, so only do it every check_every iterations
+            if self.check_every and (i + 1) % self.check_every == 0 and not active.any():
                 break
+        self.iterations = iterations
+        return u, v
 
-        U, V = u, v
+    def eps_schedule(self):
+        "Regularization of each annealing stage, decreasing from eps_start to above eps"
+        schedule = []
+        if self.eps_start is not None:
+            eps = self.eps_start
+            while eps > self.eps:
+                schedule.append(eps)
+                eps *= self.eps_decay
+        return schedule
+
+    def dual_objective(self, mu_logp, nu_logp, C, u, v, chunked=False):
+        """ Entropic dual <u,mu> + <v,nu> - eps*(sum_ij pi_ij - 1) of potentials u, v.
+            It is linear in mu and nu, so with u, v held fixed its gradient is exact at
+            any iteration count, and at convergence it equals <pi,C> - eps*H(pi). """
+        mass = torch.exp(self.lse_rows(C, u, v, chunked)).sum(-1)
+        return (torch.exp(mu_logp) * u).sum(-1) + (torch.exp(nu_logp) * v).sum(-1) - self.eps * (mass - 1)
+
+    def transport_cost(self, C, u, v, chunked=False):
+        "Transport cost and plan (None if chunked) of the dual potentials u, v"
+        if chunked:
+            return TransportCost.apply(u, v, C[0], self.eps, self.chunk_size), None
         # Transport plan pi = diag(a)*K*diag(b)
-        pi = torch.exp(self.M(self.C, U, V))
+        pi = torch.exp(self.M(C, u, v))
         # Sinkhorn distance
-        cost = torch.sum(pi * self.C, dim=(-2, -1))
+        return torch.sum(pi * C, dim=(-2, -1)), pi
 
-        if self.reduction == 'mean':
-            cost = cost.mean()
-        elif self.reduction == 'sum':
-            cost = cost.sum()
+    def lse_rows(self, C, u, v, chunked=False, eps=None):
+        "Log-sum-exp over j of the modified cost, shaped (N, H)"
+        eps = self.eps if eps is None else eps
+        if chunked:
+            return LogSumExpMatVec.apply(v, C[0], eps, self.chunk_size) + u / eps
+        return torch.logsumexp(self.M(C, u, v, eps), dim=-1)
 
-        return cost, pi
+    def lse_cols(self, C, u, v, chunked=False, eps=None):
+        "Log-sum-exp over i of the modified cost, shaped (N, W)"
+        eps = self.eps if eps is None else eps
+        if chunked:
+            return LogSumExpMatVec.apply(u, self.Ct, eps, self.chunk_size) + v / eps
+        return torch.logsumexp(self.M(C, u, v, eps).transpose(-2, -1), dim=-1)
 
-    def M(self, C, u, v):
+    def M(self, C, u, v, eps=None):
         "Modified cost for logarithmic updates"
         "$M_{ij} = (-c_{ij} + u_i + v_j) / \epsilon$"
-        return (-C + u.unsqueeze(-1) + v.unsqueeze(-2)) / self.eps
+        return (-C + u.unsqueeze(-1) + v.unsqueeze(-2)) / (self.eps if eps is None else eps)
 
 
     
 
 
+def benchmark_solvers(batch_size=16, sparse_targets=True, device='cpu', reference_iter=5000):
+    """ Error against a converged reference, iterations and time of the plain Sinkhorn
+        loop and of epsilon annealing, on random predictions and sparse random targets.
+        Then the difference between the sparse and dense target losses of each solver. """
+    torch.manual_seed(0)
+    logits = 2*torch.randn(batch_size, 1, 24, 48, device=device)
+    targets = torch.zeros_like(logits)
+    for n in range(batch_size):
+        targets.view(batch_size, -1)[n, torch.randint(0, 24*48, (int(torch.randint(1, 8, (1,))),))] = 1
+    targets /= targets.flatten(1).sum(1).view(-1, 1, 1, 1)
+
+    def run(max_iter, eps_start, sparse_targets=sparse_targets):
+        loss = SinkhornImageLoss(reduction='none', device=device, sparse_targets=sparse_targets,
+                                 max_iter=max_iter, eps_start=eps_start)
+        start = time.time()
+        with torch.no_grad():
+            cost, _ = loss(logits, targets)
+        return cost, loss.iterations.float().mean().item(), time.time() - start
+
+    reference, _, _ = run(reference_iter, 1.0)
+    print('solver     max_iter  iterations  max error (m)  time (s)')
+    for eps_start in [None, 1.0]:
+        for max_iter in [10, 50, 200]:
+            cost, iterations, elapsed = run(max_iter, eps_start)
+            print('%-10s %8d  %10.1f  %13.4f  %8.3f' % ('anneal' if eps_start else 'plain', max_iter,
+                  iterations, (cost - reference).abs().max().item(), elapsed))
+
+    print('solver     max_iter  sparse loss (m)  dense loss (m)  max difference (m)')
+    for eps_start in [None, 1.0]:
+        for max_iter in [10, 200, reference_iter]:
+            sparse, _, _ = run(max_iter, eps_start, True)
+            dense, _, _ = run(max_iter, eps_start, False)
+            print('%-10s %8d  %15.4f  %14.4f  %18.4f' % ('anneal' if eps_start else 'plain', max_iter,
+                  sparse.mean().item(), dense.mean().item(), (sparse - dense).abs().max().item()))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark Sinkhorn loss convergence and time')
+    parser.add_argument('-b', '--batch-size', type=int, default=16, dest='batch_size')
+    parser.add_argument('--dense', action='store_true', help='Use dense rather than sparse targets')
+    parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--reference-iters', type=int, default=5000, dest='reference_iters',
+                        help='Iterations of the converged reference')
+    args = parser.parse_args()
+    benchmark_solvers(args.batch_size, not args.dense, args.device, args.reference_iters)
@@ -0,0 +1,241 @@
+''' Persistent subgoal predictor for deployment on the robot. The UNet and its checkpoint
+    are loaded once, raw laser scans and image features go in, and NMS'd subgoals come
+    out as metric (heading, range) waypoints. A MicroBatcher batches concurrent
+    requests under a latency budget, and a local HTTP server exposes it:
+
+        POST /predict   body is little-endian float32, the 1440 laser ranges (meters,
+                        -1 for no return) then the 36x2048 image features in TSV order.
+                        Returns a json list of {heading, range, prob} subgoals.
+        GET /stats      json request count, batch size and p50/p99 latency. '''
+
+import json
+import time
+import queue
+import argparse
+import threading
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from collections import deque
+from concurrent.futures import Future
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from unet import UNet
+from eval import nms
+from features import VIEWS, FEATURE_SIZE
+from utils import radial_occupancy_batch, normalize_angles, RANGE_BINS, HEADING_BINS, \
+    HEADING_BIN_WIDTH, RANGE_BIN_WIDTH
+
+LASER_VALUES = 1440
+
+
+class SubgoalPredictor:
+    """ UNet loaded once from a checkpoint, predicting subgoals for batches of raw laser
+        scans and image features. Inputs are prepared exactly as DataLoader does. """
+
+    def __init__(self, checkpoint=None, device='cpu', ch=64, max_predictions=10, sigma=1.0, gaussian=False,
+                 min_prob=0.0):
+        self.device = torch.device(device)
+        self.net = UNet(n_channels=2, n_classes=1, ch=ch)
+        if checkpoint:
+            self.net.load_state_dict(torch.load(checkpoint, map_location=self.device))
+        self.net.to(device=self.device)
+        self.net.eval()
+        self.max_predictions = max_predictions
+        self.sigma = sigma
+        self.gaussian = gaussian
+        self.min_prob = min_prob
+        self.range_channel = np.linspace(-0.5, 0.5, num=RANGE_BINS).reshape(1, RANGE_BINS, 1)
+        # Centre of each grid cell, undoing the 15 degree rotation DataLoader applies
+        heading = -np.pi + (np.arange(HEADING_BINS) + 0.5)*HEADING_BIN_WIDTH - np.pi/12
+        self.cell_heading = np.tile(normalize_angles(heading), RANGE_BINS)
+        self.cell_range = np.repeat((np.arange(RANGE_BINS) + 0.5)*RANGE_BIN_WIDTH, HEADING_BINS)
+
+    def prepare(self, lasers, features):
+        ''' Model inputs from (B, 1440) laser ranges and (B, 36, 2048) features '''
+        lasers = np.asarray(lasers, dtype=np.float64)
+        # rotate scan by 15 degrees, to match the features
+        lasers = np.roll(lasers, lasers.shape[1]//24, axis=1)
+        scans = np.empty((lasers.shape[0], 2, RANGE_BINS, HEADING_BINS), dtype=np.float32)
+        scans[:, 0] = self.range_channel
+        scans[:, 1] = radial_occupancy_batch(lasers)
+        # 12 near, medium and ceiling views, rolled so zero heading is in the middle
+        features = np.asarray(features, dtype=np.float32).reshape(-1, 3, 12, FEATURE_SIZE)
+        features = np.roll(features, 6, axis=2).transpose((0, 3, 1, 2))
+        return torch.from_numpy(scans), torch.from_numpy(np.ascontiguousarray(features))
+
+    def predict_grid(self, lasers, features):
+        ''' Probability grids (B, RANGE_BINS, HEADING_BINS) and their NMS, as numpy arrays '''
+        scans, features = self.prepare(lasers, features)
+        with torch.no_grad():
+            logits = self.net(scans.to(self.device), features.to(self.device))
+            probs = F.softmax(logits.flatten(1), dim=1).reshape(logits.shape)
+            peaks = nms(probs, self.max_predictions, self.sigma, self.gaussian)
+        return probs[:, 0].cpu().numpy(), peaks[:, 0].cpu().numpy()
+
+    def subgoals(self, peaks):
+        ''' Subgoals of one NMS'd grid, most probable first '''
+        flat = peaks.reshape(-1)
+        cells = np.flatnonzero(flat > self.min_prob)
+        cells = cells[np.argsort(-flat[cells], kind='stable')]
+        return [{'heading': float(self.cell_heading[c]), 'range': float(self.cell_range[c]), 'prob': float(flat[c])}
+                for c in cells]
+
+    def predict(self, lasers, features):
+        ''' Subgoals for a batch of (B, 1440) laser ranges in meters (-1 for no return) and
+            (B, 36, 2048) image features. Headings are in radians, like the dataset's
+            target headings, and ranges in meters. '''
+        _, peaks = self.predict_grid(lasers, features)
+        return [self.subgoals(p) for p in peaks]
+
+
+class MicroBatcher:
+    """ Serves a SubgoalPredictor to concurrent callers from one worker thread. Requests
+        that arrive together are batched, up to max_batch. The worker stops waiting
+        for more once the oldest request's wait plus the recent inference time would
+        exceed latency_budget_ms. Keeps the latency of the last 10000 requests. """
+
+    def __init__(self, predictor, max_batch=16, latency_budget_ms=50):
+        self.predictor = predictor
+        self.max_batch = max_batch
+        self.latency_budget = latency_budget_ms/1000
+        self.requests = queue.Queue()
+        self.latencies = deque(maxlen=10000)
+        self.batch_sizes = deque(maxlen=10000)
+        self.inference_time = 0
+        self.worker = threading.Thread(target=self._run, daemon=True)
+        self.worker.start()
+
+    def submit(self, laser, features):
+        ''' Queue one (1440,) laser scan and (36, 2048) features, returns a Future of its subgoals '''
+        future = Future()
+        self.requests.put((time.time(), laser, features, future))
+        return future
+
+    def predict(self, laser, features):
+        return self.submit(laser, features).result()
+
+    def _next_batch(self):
+        batch = [self.requests.get()]
+        deadline = batch[0][0] + self.latency_budget - self.inference_time
+        while len(batch) < self.max_batch:
+            try:
+                batch.append(self.requests.get(timeout=max(deadline - time.time(), 0)))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            start = time.time()
+            try:
+                results = self.predictor.predict(np.stack([r[1] for r in batch]), np.stack([r[2] for r in batch]))
+            except Exception as e:
+                for r in batch:
+                    r[3].set_exception(e)
+                continue
+            done = time.time()
+            # Moving average of inference time, to leave room for it in the budget
+            elapsed = done - start
+            self.inference_time = elapsed if not self.inference_time else 0.9*self.inference_time + 0.1*elapsed
+            self.batch_sizes.append(len(batch))
+            for r, result in zip(batch, results):
+                self.latencies.append(done - r[0])
+                r[3].set_result(result)
+
+    def stats(self):
+        ''' Request count, mean batch size, p50/p99 latency and fraction over budget '''
+        latencies = np.array(self.latencies)*1000
+        if len(latencies) == 0:
+            return {'requests': 0}
+        return {
+            'requests': len(latencies),
+            'mean_batch': float(np.mean(self.batch_sizes)),
+            'p50_ms': float(np.percentile(latencies, 50)),
+            'p99_ms': float(np.percentile(latencies, 99)),
+            'over_budget': float(np.mean(latencies > self.latency_budget*1000)),
+        }
+
+
+def make_handler(batcher):
+    n_values = LASER_VALUES + VIEWS*FEATURE_SIZE
+
+    class SubgoalHandler(BaseHTTPRequestHandler):
+
+        def _reply(self, code, result):
+            body = json.dumps(result).encode()
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path == '/stats':
+                self._reply(200, batcher.stats())
+            else:
+                self._reply(404, {'error': 'Unknown path %s' % self.path})
+
+        def do_POST(self):
+            if self.path != '/predict':
+                self._reply(404, {'error': 'Unknown path %s' % self.path})
+                return
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            if len(body) != 4*n_values:
+                self._reply(400, {'error': 'Expected %d float32 values' % n_values})
+                return
+            values = np.frombuffer(body, dtype='<f4')
+            features = values[LASER_VALUES:].reshape(VIEWS, FEATURE_SIZE)
+            try:
+                subgoals = batcher.predict(values[:LASER_VALUES], features)
+            except Exception as e:
+                self.send_error(500, 'Prediction failed', str(e))
+                return
+            self._reply(200, subgoals)
+
+        def log_message(self, format, *args):
+            pass
+
+    return SubgoalHandler
+
+
+def benchmark(batcher, n_requests=200, concurrency=8):
+    ''' Send random requests from concurrency threads and return the batcher stats '''
+    lasers = np.random.uniform(0.1, 6.0, (n_requests, LASER_VALUES))
+    features = np.random.rand(n_requests, VIEWS, FEATURE_SIZE).astype(np.float32)
+
+    def client(indices):
+        for i in indices:
+            batcher.predict(lasers[i], features[i])
+
+    threads = [threading.Thread(target=client, args=(range(c, n_requests, concurrency),)) for c in range(concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return batcher.stats()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Serve subgoal predictions over local HTTP')
+    parser.add_argument('-f', '--load', dest='load', type=str, default=None, help='Load model from a .pth file')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('-p', '--port', type=int, default=8000)
+    parser.add_argument('-mb', '--max-batch', dest='max_batch', type=int, default=16,
+                        help='Largest batch of concurrent requests run together')
+    parser.add_argument('-lb', '--latency-budget', dest='latency_budget', type=float, default=50,
+                        help='Latency budget in milliseconds, bounding how long requests wait to be batched')
+    parser.add_argument('--benchmark', type=int, default=0, metavar='N',
+                        help='Instead of serving, time N concurrent random requests and print the stats')
+    args = parser.parse_args()
+
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    batcher = MicroBatcher(SubgoalPredictor(args.load, device), args.max_batch, args.latency_budget)
+    if args.benchmark:
+        print(json.dumps(benchmark(batcher, args.benchmark), indent=2))
+    else:
+        server = ThreadingHTTPServer((args.host, args.port), make_handler(batcher))
+        print('Serving subgoal predictions on http://%s:%d' % (args.host, args.port))
+        server.serve_forever()
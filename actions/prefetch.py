@@ -0,0 +1,60 @@
+''' Background batch prefetching for DataLoader using torch worker processes '''
+
+import random
+import numpy as np
+import torch
+
+
+class BatchDataset(torch.utils.data.IterableDataset):
+    """ Endless stream of batches from a DataLoader. In worker processes each
+        worker reseeds python and numpy random with its own stream, and every
+        epoch takes a disjoint slice of one permutation of the data shared by all
+        workers, so together they cover each item once per epoch. """
+
+    def __init__(self, loader, seed=1):
+        super(BatchDataset, self).__init__()
+        self.loader = loader
+        self.seed = seed
+
+    def _worker_items(self, worker_id, num_workers):
+        ''' Endless stream of this worker's items, epoch by epoch '''
+        items = list(self.loader.data)
+        epoch = 0
+        while True:
+            # Same permutation in every worker, each takes every num_workers-th item
+            order = np.random.default_rng([self.seed, epoch]).permutation(len(items))
+            for i in order[worker_id::num_workers]:
+                yield items[i]
+            epoch += 1
+
+    def __iter__(self):
+        worker_info = torch.utils.data.get_worker_info()
+        if worker_info is None:
+            while True:
+                scans, features, targets, long_ids = self.loader.get_batch()
+                yield torch.from_numpy(scans), torch.from_numpy(features), torch.from_numpy(targets), long_ids
+        # Independent, reproducible random streams per worker
+        seq = np.random.SeedSequence(self.seed).spawn(worker_info.num_workers)[worker_info.id]
+        random.seed(int(seq.generate_state(1, dtype=np.uint64)[0]))
+        np.random.seed(seq.generate_state(4))
+        items = self._worker_items(worker_info.id, worker_info.num_workers)
+        while True:
+            # The loader takes its next batch from the start of its data
+            self.loader.data = [next(items) for _ in range(self.loader.batch_size)]
+            self.loader.reset_epoch()
+            scans, features, targets, long_ids = self.loader.get_batch()
+            yield torch.from_numpy(scans), torch.from_numpy(features), torch.from_numpy(targets), long_ids
+
+
+def prefetch_batches(loader, workers=0, prefetch=2, pin_memory=False, seed=1):
+    """ Iterator over batches from loader, prepared ahead of time by worker processes.
+        Up to workers*prefetch batches are queued. With workers=0 batches are
+        prepared synchronously in this process, using the global random state. """
+    dataset = BatchDataset(loader, seed)
+    if workers == 0:
+        return iter(dataset)
+    # Forked workers share the loader's laser and feature arrays copy-on-write instead of pickling them
+    context = 'fork' if 'fork' in torch.multiprocessing.get_all_start_methods() else None
+    return iter(torch.utils.data.DataLoader(dataset, batch_size=None, num_workers=workers,
+                                            prefetch_factor=prefetch, pin_memory=pin_memory,
+                                            persistent_workers=True, multiprocessing_context=context))
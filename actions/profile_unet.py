@@ -0,0 +1,78 @@
+''' Peak memory and time of UNet training steps in each memory-lean mode. Each mode runs
+    in a fresh process, so peak resident memory on CPU is not shared between modes. '''
+
+import time
+import resource
+import argparse
+import multiprocessing
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from unet import UNet
+from utils import RANGE_BINS, HEADING_BINS
+from features import FEATURE_SIZE
+
+MODES = {
+    'default': {},
+    'fused padding': {'fused_padding': True},
+    'channels_last': {'channels_last': True},
+    'checkpointing': {'checkpointing': True},
+    'checkpoint all': {'checkpointing': 'all'},
+    'lean': {'fused_padding': True, 'channels_last': True, 'checkpointing': True},
+}
+
+
+def peak_memory_mb(device):
+    if device.type == 'cuda':
+        return torch.cuda.max_memory_allocated(device)/2**20
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/2**10
+
+
+def profile_steps(kwargs, batch_size=32, steps=5, ch=64, device='cpu'):
+    ''' Median seconds per training step after a warm up step, and peak memory in MB
+        above the memory in use before the first step '''
+    device = torch.device(device)
+    torch.manual_seed(1)
+    net = UNet(n_channels=2, n_classes=1, ch=ch, **kwargs).to(device)
+    optimizer = torch.optim.Adam(net.parameters())
+    scans = torch.rand(batch_size, 2, RANGE_BINS, HEADING_BINS, device=device)
+    features = torch.rand(batch_size, FEATURE_SIZE, 3, 12, device=device)
+    targets = torch.rand(batch_size, RANGE_BINS*HEADING_BINS, device=device)
+    targets /= targets.sum(dim=1, keepdim=True)
+    if device.type == 'cuda':
+        torch.cuda.reset_peak_memory_stats(device)
+    baseline = peak_memory_mb(device)
+    times = []
+    for step in range(steps + 1):
+        start = time.time()
+        optimizer.zero_grad()
+        logits = net(scans, features)
+        loss = -(targets*F.log_softmax(logits.flatten(1), dim=1)).sum(dim=1).mean()
+        loss.backward()
+        optimizer.step()
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+        times.append(time.time() - start)
+    return float(np.median(times[1:])), peak_memory_mb(device) - baseline
+
+
+def _profile(args):
+    return profile_steps(*args)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Profile UNet training step memory and time')
+    parser.add_argument('-b', '--batch-size', dest='batch_size', type=int, default=32)
+    parser.add_argument('-s', '--steps', type=int, default=5)
+    parser.add_argument('-ch', type=int, default=64)
+    args = parser.parse_args()
+
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    context = multiprocessing.get_context('spawn')
+    print('Batch size %d on %s' % (args.batch_size, device))
+    print('mode            step (ms)  peak memory (MB)')
+    for name, kwargs in MODES.items():
+        with context.Pool(1) as pool:
+            step, memory = pool.apply(_profile, ((kwargs, args.batch_size, args.steps, args.ch, device),))
+        print('%-14s  %9.1f  %16.1f' % (name, 1000*step, memory))
@@ -196,19 +196,46 @@ PYBIND11_MODULE(TORCH_EXTENSION_NAME, m) {
 
 """
 
-#wasserstein_ext = torch.utils.cpp_extension.load_inline("wasserstein", cpp_sources="", cuda_sources=cuda_source,
-#                                                    extra_cuda_cflags=["--expt-relaxed-constexpr"]   )
+_wasserstein_ext = None
+
+
+def wasserstein_ext():
+    # the CUDA extension, compiled on first use, or None if it cannot be built here
+    global _wasserstein_ext
+    if _wasserstein_ext is None:
+        try:
+            _wasserstein_ext = torch.utils.cpp_extension.load_inline("wasserstein", cpp_sources="", cuda_sources=cuda_source,
+                                                                     extra_cuda_cflags=["--expt-relaxed-constexpr"])
+        except (ImportError, OSError, RuntimeError) as e:
+            print('Using the batched sinkstep, the CUDA extension could not be built: %s' % e)
+            _wasserstein_ext = False
+    return _wasserstein_ext or None
+
+
+def sinkstep_batched(dist, log_nu, log_u, lam: float, chunk_size: int = 16):
+    # same as the CUDA kernel for the whole batch at once, over chunks of columns j so only a
+    # (batch, chunk_size, n) temporary is held. Shifted exponents are clamped at -80, which
+    # is exact in float32 but avoids the slow path exp takes for very negative arguments.
+    dist_t = (dist/lam).t().contiguous()
+    log_v = torch.empty_like(log_nu)
+    for s in range(0, dist.size(1), chunk_size):
+        x = log_u.unsqueeze(1) - dist_t[s:s+chunk_size].unsqueeze(0)
+        max_x = x.amax(2, keepdim=True)
+        shift = torch.where(max_x == float('-inf'), torch.zeros_like(max_x), max_x)
+        lse = x.sub_(shift).clamp_(min=-80).exp_().sum(2).log_() + shift.squeeze(2)
+        # log_v is -inf where log_nu is -inf, or every log_u is -inf
+        log_v[:, s:s+chunk_size] = torch.where(max_x.squeeze(2) == float('-inf'), max_x.squeeze(2),
+                                               log_nu[:, s:s+chunk_size] - lse)
+    return log_v
+
 
 def sinkstep(dist, log_nu, log_u, lam: float):
-    # dispatch to optimized GPU implementation for GPU tensors, slow fallback for CPU
-    #if dist.is_cuda:
-    #    return wasserstein_ext.sinkstep(dist, log_nu, log_u, lam)
+    # dispatch to optimized GPU implementation for GPU tensors, batched fallback otherwise
+    if dist.is_cuda and wasserstein_ext() is not None:
+        return wasserstein_ext().sinkstep(dist, log_nu, log_u, lam)
     assert dist.dim() == 2 and log_nu.dim() == 2 and log_u.dim() == 2
     assert dist.size(0) == log_u.size(1) and dist.size(1) == log_nu.size(1) and log_u.size(0) == log_nu.size(0)
-    log_v = log_nu.clone()
-    for b in range(log_u.size(0)):
-        log_v[b] -= torch.logsumexp(-dist/lam+log_u[b, :, None], 1)
-    return log_v
+    return sinkstep_batched(dist, log_nu, log_u, lam)
 
 
 class SinkhornOT(torch.autograd.Function):
@@ -0,0 +1,163 @@
+''' Precomputed subgoal lookup tables for simulator agents. The viewpoints of a scan and
+    their laser scans and image features are fixed, so the trained model is run once
+    over every viewpoint, each of the 12 rotations by 30 degrees and each laser
+    dropout seed. Each scan is stored in subgoal table files:
+
+        <scan>.npy              float16 probability grids, (viewpoints, 12, seeds, 24, 48)
+        <scan>.subgoals.npy     float32 NMS'd subgoals, (viewpoints, 12, seeds, max_predictions, 3)
+                                as (heading, range, prob), most probable first, padded with 0 prob
+        <scan>.index.json       viewpoint rows, seeds and the settings the table was built with
+
+    SubgoalTable memory maps them, so each agent query is a dict lookup and a single
+    read. Headings are in the frame of the rotated inputs, as for SubgoalPredictor. '''
+
+import os
+import json
+import time
+import zlib
+import argparse
+import numpy as np
+import torch
+
+from predictor import SubgoalPredictor
+from features import load_img_features, VIEWS, FEATURE_SIZE
+from laser_scans import load_laser_scans
+from utils import load_scenes, DATA_DIR, RANGE_BINS, HEADING_BINS
+
+SUBGOAL_DIR = 'subgoals/'
+ROTATIONS = 12
+
+
+def table_paths(directory, scan):
+    ''' Paths of the grid, subgoal and index files of a scan's table '''
+    prefix = os.path.join(directory, scan)
+    return prefix + '.npy', prefix + '.subgoals.npy', prefix + '.index.json'
+
+
+def scan_inputs(laser, features, rotation, rng, dropout=0, laser_fov_deg=270):
+    ''' Raw laser ranges and features of one viewpoint, rotated and with missing returns
+        drawn as DataLoader does. features is a list of feature versions. '''
+    length = len(laser)
+    version = rng.integers(len(features))
+    # rotate scan and features by the same 30 degree increment
+    laser = np.roll(laser, int(length/ROTATIONS*rotation))
+    feats = np.roll(features[version].reshape(3, ROTATIONS, FEATURE_SIZE), rotation, axis=1).reshape(VIEWS, FEATURE_SIZE)
+    # missing part of scan, wrapping around the end, and dropout of single returns
+    miss_length = int((360-laser_fov_deg)/360 * length)
+    missing = (np.arange(length) - rng.integers(length + 1)) % length < miss_length
+    laser[missing | (rng.random(length) < dropout)] = -1
+    return laser, feats
+
+
+def build_scan_table(predictor, scan, features, directory=SUBGOAL_DIR, seeds=(0,), dropout=0, laser_fov_deg=270,
+                     batch_size=64, checkpoint=None):
+    ''' Run predictor over every viewpoint of scan with image features, for every rotation
+        and seed, and write the scan's table. Returns the number of viewpoints. '''
+    items = [item for item in load_laser_scans(DATA_DIR + scan) if scan + '_' + item['image_id'] in features]
+    jobs = [(v, r, s) for v in range(len(items)) for r in range(ROTATIONS) for s in range(len(seeds))]
+    grids = np.zeros((len(items), ROTATIONS, len(seeds), RANGE_BINS, HEADING_BINS), dtype=np.float16)
+    subgoals = np.zeros((len(items), ROTATIONS, len(seeds), predictor.max_predictions, 3), dtype=np.float32)
+    for start in range(0, len(jobs), batch_size):
+        lasers, feats = [], []
+        for v, r, s in jobs[start:start+batch_size]:
+            item = items[v]
+            # Same draws for a viewpoint and seed at every rotation, independent of viewpoint order
+            rng = np.random.default_rng([seeds[s], zlib.crc32(item['image_id'].encode())])
+            laser, feat = scan_inputs(np.array(item['laser'], dtype=np.float64), features[scan + '_' + item['image_id']],
+                                      r, rng, dropout, laser_fov_deg)
+            lasers.append(laser)
+            feats.append(feat)
+        probs, peaks = predictor.predict_grid(np.stack(lasers), np.stack(feats))
+        for (v, r, s), prob, peak in zip(jobs[start:start+batch_size], probs, peaks):
+            grids[v, r, s] = prob
+            for n, subgoal in enumerate(predictor.subgoals(peak)[:predictor.max_predictions]):
+                subgoals[v, r, s, n] = subgoal['heading'], subgoal['range'], subgoal['prob']
+
+    grid_path, subgoal_path, index_path = table_paths(directory, scan)
+    np.save(grid_path + '.tmp.npy', grids)
+    np.save(subgoal_path + '.tmp.npy', subgoals)
+    os.replace(grid_path + '.tmp.npy', grid_path)
+    os.replace(subgoal_path + '.tmp.npy', subgoal_path)
+    # Write the index last, so a table with an index is complete
+    index = {
+        'scan': scan,
+        'viewpoints': {item['image_id']: v for v, item in enumerate(items)},
+        'seeds': list(seeds),
+        'rotations': ROTATIONS,
+        'dropout': dropout,
+        'laser_fov_deg': laser_fov_deg,
+        'max_predictions': predictor.max_predictions,
+        'sigma': predictor.sigma,
+        'gaussian': predictor.gaussian,
+        'checkpoint': checkpoint,
+    }
+    with open(index_path + '.tmp', 'w') as f:
+        json.dump(index, f)
+    os.replace(index_path + '.tmp', index_path)
+    return len(items)
+
+
+class SubgoalTable:
+    """ Lookup of precomputed subgoals by scan, viewpoint, rotation and seed. The tables
+        of a scan are memory mapped on first use, so reads share the page cache. """
+
+    def __init__(self, directory=SUBGOAL_DIR):
+        self.directory = directory
+        self.tables = {}
+
+    def _table(self, scan):
+        if scan not in self.tables:
+            grid_path, subgoal_path, index_path = table_paths(self.directory, scan)
+            with open(index_path) as f:
+                index = json.load(f)
+            index['seeds'] = {seed: s for s, seed in enumerate(index['seeds'])}
+            self.tables[scan] = (index, np.load(grid_path, mmap_mode='r'), np.load(subgoal_path, mmap_mode='r'))
+        return self.tables[scan]
+
+    def _entry(self, scan, viewpoint, rotation, seed):
+        index, grids, subgoals = self._table(scan)
+        s = 0 if seed is None else index['seeds'][seed]
+        return (index['viewpoints'][viewpoint], rotation % index['rotations'], s), grids, subgoals
+
+    def grid(self, scan, viewpoint, rotation=0, seed=None):
+        ''' (RANGE_BINS, HEADING_BINS) float32 subgoal probabilities. Rotation is in 30
+            degree increments, seed defaults to the first seed of the table. '''
+        ix, grids, _ = self._entry(scan, viewpoint, rotation, seed)
+        return grids[ix].astype(np.float32)
+
+    def subgoals(self, scan, viewpoint, rotation=0, seed=None):
+        ''' Subgoals as SubgoalPredictor.predict returns them, a list of {heading, range,
+            prob} with headings in radians and ranges in meters '''
+        ix, _, subgoals = self._entry(scan, viewpoint, rotation, seed)
+        return [{'heading': float(h), 'range': float(r), 'prob': float(p)} for h, r, p in subgoals[ix] if p > 0]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Precompute subgoal lookup tables for every viewpoint of each scan')
+    parser.add_argument('-f', '--load', dest='load', type=str, required=True, help='Load model from a .pth file')
+    parser.add_argument('-o', '--output', default=SUBGOAL_DIR, help='Directory of the subgoal tables')
+    parser.add_argument('--splits', nargs='+', default=['train', 'val', 'test'])
+    parser.add_argument('--scans', nargs='+', default=None, help='Only these scans, instead of all scans in splits')
+    parser.add_argument('--seeds', nargs='+', type=int, default=[0], help='Laser dropout seeds')
+    parser.add_argument('-sd', '--scan-dropout', metavar='SD', type=float, default=0, dest='scan_dropout',
+                        help='Dropout on scans, as in DataLoader')
+    parser.add_argument('--fov', type=float, default=270, help='Laser field of view in degrees')
+    parser.add_argument('-b', '--batch-size', dest='batch_size', type=int, default=64)
+    parser.add_argument('-mp', '--max-predictions', dest='max_predictions', type=int, default=10)
+    parser.add_argument('--sigma', type=float, default=1.0, help='NMS sigma')
+    parser.add_argument('--gaussian', action='store_true', help='Gaussian instead of box NMS')
+    parser.add_argument('--overwrite', action='store_true', help='Rebuild tables that already exist')
+    args = parser.parse_args()
+
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    predictor = SubgoalPredictor(args.load, device, max_predictions=args.max_predictions, sigma=args.sigma,
+                                 gaussian=args.gaussian)
+    features = load_img_features(splits=args.splits)
+    os.makedirs(args.output, exist_ok=True)
+    for scan in args.scans or load_scenes(args.splits):
+        if not args.overwrite and os.path.exists(table_paths(args.output, scan)[2]):
+            continue
+        start = time.time()
+        n = build_scan_table(predictor, scan, features, args.output, args.seeds, args.scan_dropout, args.fov,
+                             args.batch_size, args.load)
+        print('Built subgoal table of %d viewpoints for %s in %0.1f seconds' % (n, scan, time.time() - start))
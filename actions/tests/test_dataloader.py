@@ -0,0 +1,58 @@
+import math
+import random
+import numpy as np
+import torch
+
+import dataloader
+from dataloader import DataLoader, DeviceDataLoader
+from features import VIEWS, FEATURE_SIZE
+from utils import radial_target, radial_target_batch, radial_target_cells, radial_target_from_cells, \
+    radial_target_torch
+
+
+def fake_data(n_items=6, seed=0):
+    rng = np.random.default_rng(seed)
+    items = []
+    for i in range(n_items):
+        n_targets = rng.integers(1, 4)
+        items.append({
+            'scan': 'scan%d' % (i % 2),
+            'image_id': 'vp%d' % i,
+            'position': {'x': 0.0, 'y': 0.0, 'z': 0.0},
+            'laser': rng.uniform(0.1, 6.0, 1440),
+            'target_heading': rng.uniform(-math.pi, math.pi, n_targets),
+            'target_range': rng.uniform(0.3, 4.5, n_targets),
+        })
+    features = {item['scan'] + '_' + item['image_id']: [rng.random((VIEWS, FEATURE_SIZE), dtype=np.float32)]
+                for item in items}
+    return items, features
+
+
+def test_target_encoders_agree_at_pi():
+    heading = np.array([math.pi, -math.pi, 0.0, math.pi - 1e-12])
+    dist = np.array([1.0, 2.0, 3.0, 4.0])
+    dense = radial_target(heading, dist)[..., 0]
+    assert dense[5, 0] == 1 and dense[10, 0] == 1
+    np.testing.assert_array_equal(radial_target_batch([heading], [dist])[0], dense)
+    np.testing.assert_array_equal(radial_target_from_cells(radial_target_cells(heading, dist)[None])[0], dense)
+    torch_dense = radial_target_torch(torch.from_numpy(heading), torch.from_numpy(dist),
+                                      torch.zeros(len(heading), dtype=torch.long), 1)[0]
+    np.testing.assert_array_equal(torch_dense.numpy(), dense)
+
+
+def test_device_loader_matches_without_random_draws(monkeypatch):
+    items, features = fake_data()
+    monkeypatch.setattr(dataloader, 'load_data', lambda splits: [dict(item) for item in items])
+    random.seed(0)
+    host = DataLoader(features, bs=3, laser_fov_deg=360)
+    random.seed(0)
+    device = DeviceDataLoader(features, torch.device('cpu'), bs=3, laser_fov_deg=360)
+    assert device.target_cells is None
+    # One epoch, as DataLoader's reshuffle at the end of an epoch follows its own random draws
+    for _ in range(2):
+        scans, feats, targets, long_ids = host.get_batch()
+        d_scans, d_feats, d_targets, d_long_ids = device.get_batch()
+        assert long_ids == d_long_ids
+        np.testing.assert_array_equal(d_scans.numpy(), scans)
+        np.testing.assert_array_equal(d_feats.numpy(), feats)
+        np.testing.assert_allclose(d_targets.numpy(), targets, rtol=1e-6)
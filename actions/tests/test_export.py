@@ -0,0 +1,52 @@
+import pytest
+import torch
+
+from export import quantize_int8, export_torchscript
+from unet import UNet
+
+
+def inputs(batch_size=2, seed=0):
+    g = torch.Generator().manual_seed(seed)
+    return torch.rand((batch_size, 2, 24, 48), generator=g), torch.rand((batch_size, 2048, 3, 12), generator=g)
+
+
+def peaked_net(fused_padding):
+    ''' Random model with BatchNorm statistics of the test inputs, so activations are not
+        near constant, and a scaled output layer, so its predictions are peaked '''
+    torch.manual_seed(0)
+    net = UNet(n_channels=2, n_classes=1, ch=16, fused_padding=fused_padding)
+    for module in net.modules():
+        if isinstance(module, torch.nn.BatchNorm2d):
+            module.momentum = None
+    with torch.no_grad():
+        for seed in range(3):
+            net(*inputs(seed=seed))
+        net.outc.conv.weight.mul_(100)
+    return net.eval()
+
+
+@pytest.mark.parametrize('fused_padding', [False, True])
+def test_quantize_int8_close_to_fp32(fused_padding):
+    net = peaked_net(fused_padding)
+    quantized = quantize_int8(net, [inputs(seed=s) for s in range(3)])
+    scans, features = inputs(seed=3)
+    with torch.no_grad():
+        expected = net(scans, features).flatten(1)
+        actual = quantized(scans, features).flatten(1)
+    # Softmax ignores a constant shift of the logits, so compare them about their means
+    expected = expected - expected.mean(dim=1, keepdim=True)
+    actual = actual - actual.mean(dim=1, keepdim=True)
+    assert expected.std() > 1
+    assert ((actual - expected).norm(dim=1) / expected.norm(dim=1)).max() < 0.35
+    assert torch.equal(actual.argmax(dim=1), expected.argmax(dim=1))
+
+
+@pytest.mark.parametrize('fused_padding', [False, True])
+def test_torchscript_matches_eager(fused_padding, tmp_path):
+    torch.manual_seed(0)
+    net = UNet(n_channels=2, n_classes=1, ch=16, fused_padding=fused_padding).eval()
+    export_torchscript(net, str(tmp_path / 'unet.pt'))
+    traced = torch.jit.load(str(tmp_path / 'unet.pt'))
+    scans, features = inputs(seed=1)
+    with torch.no_grad():
+        torch.testing.assert_close(traced(scans, features), net(scans, features))
@@ -0,0 +1,27 @@
+import numpy as np
+
+from features import FeatureStore, FeatureTable, VIEWS, FEATURE_SIZE
+
+
+def expected_batch(versions, rotations):
+    ''' Features rolled so zero heading is in the middle, then by each rotation, as
+        the table copied them in before '''
+    return np.stack([np.roll(v.reshape(3, 12, FEATURE_SIZE), 6 + r, axis=1).transpose((2, 0, 1))
+                     for v, r in zip(versions, rotations)])
+
+
+def test_table_shares_store_and_gathers_rolled_views(tmp_path):
+    rng = np.random.default_rng(0)
+    np.save(tmp_path / 'store.npy', rng.random((5, VIEWS, FEATURE_SIZE), dtype=np.float32))
+    data = np.load(tmp_path / 'store.npy', mmap_mode='r')
+    store = FeatureStore(data, {'a_1': [0, 3], 'b_2': [4]})
+    rows, rotations = [3, 4, 0], [0, 5, 12]
+
+    shared = FeatureTable(store)
+    assert np.shares_memory(shared.data, data)
+    np.testing.assert_array_equal(shared.gather(rows, rotations), expected_batch(data[rows], rotations))
+
+    half = FeatureTable(store, dtype=np.float16)
+    assert half.data.dtype == np.float16 and not np.shares_memory(half.data, data)
+    np.testing.assert_array_equal(half.gather([half.rows['a_1'][1], half.rows['b_2'][0]], [1, 2]),
+                                  expected_batch(data[[3, 4]].astype(np.float16), [1, 2]).astype(np.float32))
@@ -0,0 +1,74 @@
+import torch
+
+from loss import SinkhornDistance, SinkhornImageLoss
+
+
+def small_problem(batch_size=3, n=6, m=6, seed=0):
+    ''' Log probability logits and a (1, n, m) distance cost between random points '''
+    g = torch.Generator().manual_seed(seed)
+    mu_logits = torch.randn((batch_size, n), generator=g, dtype=torch.float64)
+    nu_logits = torch.randn((batch_size, m), generator=g, dtype=torch.float64)
+    C = torch.cdist(torch.rand((n, 2), generator=g, dtype=torch.float64),
+                    torch.rand((m, 2), generator=g, dtype=torch.float64)).unsqueeze(0)
+    return mu_logits, nu_logits, C
+
+
+def test_implicit_gradcheck_at_convergence():
+    mu_logits, nu_logits, C = small_problem()
+    criterion = SinkhornDistance(C, eps=0.1, max_iter=2000, reduction='sum', implicit=True, thresh=1e-13)
+
+    def loss(mu_logits, nu_logits):
+        return criterion(torch.log_softmax(mu_logits, 1), torch.log_softmax(nu_logits, 1))[0]
+
+    assert torch.autograd.gradcheck(loss, (mu_logits.requires_grad_(), nu_logits.requires_grad_()))
+
+
+def test_implicit_matches_unrolled_dual():
+    mu_logits, nu_logits, C = small_problem()
+    mu_logits.requires_grad_()
+    criterion = SinkhornDistance(C, eps=0.1, max_iter=2000, reduction='sum', thresh=1e-13)
+    mu_logp, nu_logp = torch.log_softmax(mu_logits, 1), torch.log_softmax(nu_logits, 1)
+    u, v = criterion.iterate(mu_logp, nu_logp, C)
+    unrolled, = torch.autograd.grad(criterion.dual_objective(mu_logp, nu_logp, C, u, v).sum(), mu_logits)
+
+    criterion.implicit = True
+    loss, _ = criterion(torch.log_softmax(mu_logits, 1), nu_logp)
+    implicit, = torch.autograd.grad(loss, mu_logits)
+    torch.testing.assert_close(implicit, unrolled)
+    # At convergence the dual is the transport cost less eps times the plan's entropy
+    pi = torch.exp(criterion.M(C, u, v))
+    torch.testing.assert_close(loss, ((pi * C).sum() + criterion.eps * (pi * torch.log(pi)).sum()).detach())
+
+
+def test_implicit_chunked_matches_dense():
+    mu_logits, nu_logits, C = small_problem()
+    mu_logp, nu_logp = torch.log_softmax(mu_logits, 1), torch.log_softmax(nu_logits, 1)
+    dense, _ = SinkhornDistance(C, eps=0.1, implicit=True, reduction='none')(mu_logp, nu_logp)
+    chunked, _ = SinkhornDistance(C, eps=0.1, implicit=True, reduction='none', chunk_size=4)(mu_logp, nu_logp)
+    torch.testing.assert_close(chunked, dense)
+
+
+def grid_problem(batch_size=4, height=4, width=6, seed=0):
+    ''' Random logits and targets with up to 3 bins of mass on a small grid, and the
+        (1, N, N) distance cost between its cells '''
+    g = torch.Generator().manual_seed(seed)
+    cells = torch.stack(torch.meshgrid(torch.arange(height), torch.arange(width), indexing='ij'), -1)
+    cells = cells.reshape(-1, 2).float()
+    logits = 2*torch.randn((batch_size, 1, height, width), generator=g)
+    targets = torch.zeros_like(logits)
+    for n in range(batch_size):
+        targets.view(batch_size, -1)[n, torch.randint(0, height*width, (3,), generator=g)] = 1
+    targets /= targets.flatten(1).sum(1).view(-1, 1, 1, 1)
+    return logits, targets, torch.cdist(cells, cells).unsqueeze(0)/2
+
+
+def test_sparse_targets_match_dense_at_convergence():
+    logits, targets, C = grid_problem()
+    losses = []
+    for sparse_targets in [False, True]:
+        loss = SinkhornImageLoss(reduction='none', device='cpu', sparse_targets=sparse_targets, max_iter=2000)
+        loss.C = loss.criterion.C = C
+        loss.criterion.thresh = 1e-6
+        losses.append(loss(logits, targets)[0])
+        assert (loss.iterations < 2000).all()
+    assert (losses[0] - losses[1]).abs().max() < 1e-3
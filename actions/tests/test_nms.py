@@ -0,0 +1,39 @@
+import pytest
+import torch
+import torch.nn.functional as F
+
+from eval import nms, greedy_nms
+
+
+def random_grids(batch_size=64, seed=0):
+    g = torch.Generator().manual_seed(seed)
+    return torch.rand((batch_size, 1, 24, 48), generator=g)
+
+
+def smoothed_grids(batch_size=64, seed=0):
+    ''' Softmax of blurred random logits, like the model's predictions '''
+    g = torch.Generator().manual_seed(seed)
+    logits = 4*torch.randn((batch_size, 1, 24, 48), generator=g)
+    kernel = torch.ones((1, 1, 5, 5))/25
+    logits = F.conv2d(F.pad(logits, (2, 2, 0, 0), mode='circular'), kernel, padding=(2, 0))
+    return F.softmax(logits.flatten(1), dim=1).reshape(logits.shape)
+
+
+@pytest.mark.parametrize('gaussian', [False, True])
+@pytest.mark.parametrize('sigma', [1.0, 2.0])
+@pytest.mark.parametrize('grids', [random_grids, smoothed_grids])
+def test_nms_matches_greedy(grids, sigma, gaussian):
+    pred = grids()
+    for max_predictions in [1, 5, 10]:
+        torch.testing.assert_close(nms(pred, max_predictions, sigma, gaussian),
+                                   greedy_nms(pred, max_predictions, sigma, gaussian), rtol=0, atol=0)
+
+
+@pytest.mark.parametrize('gaussian', [False, True])
+def test_nms_matches_greedy_with_ties(gaussian):
+    # Flat, quantized and mostly zero grids
+    grids = random_grids(16)
+    pred = torch.cat([torch.full((2, 1, 24, 48), 1/1152), (grids[:8]*4).floor()/4, grids[8:]*(grids[8:] > 0.98)])
+    for max_predictions in [1, 10, 40]:
+        torch.testing.assert_close(nms(pred, max_predictions, 1.0, gaussian),
+                                   greedy_nms(pred, max_predictions, 1.0, gaussian), rtol=0, atol=0)
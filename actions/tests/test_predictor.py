@@ -0,0 +1,82 @@
+import json
+import threading
+import urllib.error
+import urllib.request
+import numpy as np
+import pytest
+
+from http.server import ThreadingHTTPServer
+
+from features import FeatureTable, VIEWS, FEATURE_SIZE
+from predictor import SubgoalPredictor, MicroBatcher, make_handler, LASER_VALUES
+from utils import radial_occupancy_batch, RANGE_BINS, HEADING_BINS
+
+
+class FailingPredictor:
+    def predict(self, lasers, features):
+        raise RuntimeError('out of memory')
+
+
+def random_request(seed=0):
+    rng = np.random.default_rng(seed)
+    return rng.uniform(0.1, 6.0, LASER_VALUES), rng.random((VIEWS, FEATURE_SIZE), dtype=np.float32)
+
+
+def test_prepare_matches_dataloader():
+    laser, features = random_request()
+    scans, feats = SubgoalPredictor(ch=16).prepare(laser[None], features[None])
+    assert scans.shape == (1, 2, RANGE_BINS, HEADING_BINS)
+    np.testing.assert_array_equal(scans[0, 0].numpy(), np.broadcast_to(np.linspace(-0.5, 0.5, RANGE_BINS)[:, None],
+                                                                       (RANGE_BINS, HEADING_BINS)).astype(np.float32))
+    # DataLoader rolls the scan by 15 degrees and gathers the features from a FeatureTable
+    np.testing.assert_array_equal(scans[0, 1].numpy(), radial_occupancy_batch(np.roll(laser, LASER_VALUES//24)[None])[0])
+    np.testing.assert_array_equal(feats.numpy(), FeatureTable({'scan_image': [features]}).gather([0]))
+
+
+@pytest.fixture
+def serve():
+    servers = []
+
+    def serve(predictor):
+        server = ThreadingHTTPServer(('127.0.0.1', 0), make_handler(MicroBatcher(predictor)))
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return 'http://127.0.0.1:%d' % server.server_address[1]
+
+    yield serve
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def post(url, body):
+    try:
+        with urllib.request.urlopen(urllib.request.Request(url + '/predict', data=body)) as response:
+            return response.status, response.read()
+    except urllib.error.HTTPError as e:
+        return e.code, e.read()
+
+
+def test_server_replies(serve):
+    url = serve(SubgoalPredictor(ch=16))
+    laser, features = random_request()
+    body = np.concatenate([laser, features.reshape(-1)]).astype('<f4').tobytes()
+
+    code, reply = post(url, body[:-4])
+    assert code == 400
+    code, reply = post(url, body)
+    assert code == 200
+    subgoals = json.loads(reply)
+    assert 0 < len(subgoals) <= 10
+    assert set(subgoals[0]) == {'heading', 'range', 'prob'}
+    assert all(a['prob'] >= b['prob'] for a, b in zip(subgoals, subgoals[1:]))
+    with urllib.request.urlopen(url + '/stats') as response:
+        assert json.loads(response.read())['requests'] == 1
+
+
+def test_server_replies_500_when_prediction_fails(serve):
+    url = serve(FailingPredictor())
+    laser, features = random_request()
+    code, reply = post(url, np.concatenate([laser, features.reshape(-1)]).astype('<f4').tobytes())
+    assert code == 500
+    assert b'out of memory' in reply
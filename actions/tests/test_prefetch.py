@@ -0,0 +1,29 @@
+import numpy as np
+
+from prefetch import prefetch_batches
+
+
+class ItemLoader:
+    """ Stand-in for DataLoader, whose batches are the ids of the items in them """
+
+    def __init__(self, n_items, bs):
+        self.data = [{'id': i} for i in range(n_items)]
+        self.batch_size = bs
+        self.reset_epoch()
+
+    def reset_epoch(self):
+        self.ix = 0
+
+    def get_batch(self):
+        batch = self.data[self.ix:self.ix+self.batch_size]
+        self.ix += self.batch_size
+        ids = np.array([item['id'] for item in batch], dtype=np.float32)
+        return ids, ids, ids, [item['id'] for item in batch]
+
+
+def test_workers_cover_each_item_once_per_epoch():
+    n_items, bs = 48, 4
+    batches = prefetch_batches(ItemLoader(n_items, bs), workers=2)
+    for epoch in range(2):
+        ids = [i for _ in range(n_items//bs) for i in next(batches)[3]]
+        assert sorted(ids) == list(range(n_items))
@@ -0,0 +1,61 @@
+import pytest
+import torch
+
+from unet import UNet
+from unet.unet_parts import RadialPad, fused_radial_pad
+
+
+@pytest.mark.parametrize('channels_last', [False, True])
+@pytest.mark.parametrize('padding', [(1, 1, 1, 1), (0, 1, 0, 0), (2, 1, 3, 2)])
+def test_fused_radial_pad_matches_pads(padding, channels_last):
+    top, bottom, left, right = padding
+    x = torch.randn(2, 3, 6, 12, dtype=torch.float64)
+    if channels_last:
+        x = x.contiguous(memory_format=torch.channels_last)
+    x.requires_grad_()
+    expected = torch.nn.functional.pad(x, [0, 0, top, bottom], mode='replicate')
+    expected = torch.nn.functional.pad(expected, [left, right, 0, 0], mode='circular')
+    actual = fused_radial_pad(x, top, bottom, left, right)
+    assert torch.equal(actual, expected)
+    assert actual.is_contiguous(memory_format=torch.channels_last) == channels_last
+    grad = torch.randn_like(expected)
+    expected_grad, = torch.autograd.grad(expected, x, grad)
+    actual_grad, = torch.autograd.grad(actual, x, grad)
+    torch.testing.assert_close(actual_grad, expected_grad)
+    assert torch.autograd.gradcheck(lambda x: fused_radial_pad(x, top, bottom, left, right), (x,))
+    if padding[0] == padding[1] == padding[2] == padding[3]:
+        assert torch.equal(RadialPad(top)(x), expected)
+
+
+def step(kwargs, train):
+    ''' Output, parameter gradients and state after one step of a UNet with kwargs,
+        from the same weights and inputs '''
+    torch.manual_seed(0)
+    state = UNet(2, 1, ch=8, dropout=0).state_dict()
+    net = UNet(2, 1, ch=8, dropout=0, **kwargs)
+    net.load_state_dict(state)
+    net.train(train)
+    g = torch.Generator().manual_seed(1)
+    out = net(torch.rand((3, 2, 24, 48), generator=g), torch.rand((3, 2048, 3, 12), generator=g))
+    grads = None
+    if train:
+        out.sum().backward()
+        grads = torch.cat([p.grad.flatten() for p in net.parameters()])
+    return out, grads, net.state_dict()
+
+
+@pytest.mark.parametrize('kwargs', [{'fused_padding': True}, {'channels_last': True}, {'checkpointing': True},
+                                    {'checkpointing': 'all'},
+                                    {'fused_padding': True, 'channels_last': True, 'checkpointing': True}])
+@pytest.mark.parametrize('train', [False, True])
+def test_lean_modes_match_default(kwargs, train):
+    out, grads, state = step({}, train)
+    lean_out, lean_grads, lean_state = step(kwargs, train)
+    torch.testing.assert_close(lean_out, out, rtol=1e-4, atol=1e-4)
+    if train:
+        # channels_last convolutions sum in another order, so compare to the gradient scale
+        torch.testing.assert_close(lean_grads, grads, rtol=0, atol=1e-5*grads.abs().max().item())
+    assert state.keys() == lean_state.keys()
+    for key in state:
+        # Running stats and num_batches_tracked are updated once, checkpointed or not
+        torch.testing.assert_close(lean_state[key], state[key], rtol=1e-4, atol=1e-5)
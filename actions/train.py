@@ -8,11 +8,12 @@ import torch
 import torch.nn as nn
 from torch import optim
 from tqdm import tqdm
-from loss import SinkhornImageLoss
+from loss import SinkhornImageLoss, DualCache
 
 from eval import eval_net
-from dataloader import DataLoader
-from utils import read_img_features
+from dataloader import DataLoader, DeviceDataLoader
+from prefetch import prefetch_batches
+from features import load_img_features, FeatureTable
 from unet import UNet
 
 torch.set_printoptions(precision=3, sci_mode=False)
@@ -28,10 +29,19 @@ def train_net(net,
               num_examples=20,
               lr=0.1,
               save_cp=True,
-              scan_dropout=0):
-
-    features = read_img_features()
-    train = DataLoader(features, splits=['train'], bs=batch_size, augment=True, dropout=scan_dropout)
+              scan_dropout=0,
+              workers=0,
+              device_data=False,
+              half_features=False,
+              loss_args={}):
+
+    # One table of features shared by the train and val loaders
+    features = FeatureTable(load_img_features(splits=['train', 'val']),
+                            dtype=np.float16 if half_features else np.float32)
+    if device_data:
+        train = DeviceDataLoader(features, device, splits=['train'], bs=batch_size, augment=True, dropout=scan_dropout)
+    else:
+        train = DataLoader(features, splits=['train'], bs=batch_size, augment=True, dropout=scan_dropout)
     val = DataLoader(features, splits=['val'], bs=batch_size, dropout=scan_dropout)
     n_train = len(train.data)
     n_val = len(val.data)
@@ -42,35 +52,46 @@ def train_net(net,
         Learning rate:   {lr}
         Training size:   {n_train}
         Scan dropout:    {scan_dropout}
+        Loader workers:  {workers}
+        Device data:     {device_data}
+        Half features:   {half_features}
         Validation size: {n_val}
         Checkpoints:     {save_cp}
         Device:          {device.type}
     ''')
 
     optimizer = optim.Adam(net.parameters(), lr=lr)
-    criterion = SinkhornImageLoss()
+    criterion = SinkhornImageLoss(device=device, **loss_args)
 
-    val_loss, val_emd = eval_net(net, val, device, num_examples)
+    val_loss, val_emd = eval_net(net, val, device, num_examples, loss_args)
     logging.info('Validation Loss at Initialization: {0:.2f}m'.format(val_loss))
     logging.info('Validation EMD at Initialization: {0:.2f}m'.format(val_emd))
 
+    if device_data:
+        # Batches are built on the device, so there is nothing to prefetch
+        batches = iter(train.get_batch, None)
+    else:
+        batches = prefetch_batches(train, workers=workers, pin_memory=device.type == 'cuda')
     for epoch in range(epochs):
         net.train()
 
         epoch_loss = 0
+        # Kept on the device, so it adds no synchronization
+        epoch_iterations = 0
         n_batches = n_train//batch_size
         with tqdm(total=n_train, desc=f'Epoch {epoch + 1}/{epochs}', unit='img') as pbar:
             for i in range(n_batches):
 
-                scans, feats, true_masks, _ = train.get_batch()
+                scans, feats, true_masks, long_ids = next(batches)
 
-                scans = torch.from_numpy(scans).to(device=device)
-                feats = torch.from_numpy(feats).to(device=device)
-                true_masks = torch.from_numpy(true_masks).to(device=device)
+                scans = scans.to(device=device, non_blocking=True)
+                feats = feats.to(device=device, non_blocking=True)
+                true_masks = true_masks.to(device=device, non_blocking=True)
 
                 masks_pred = net(scans,feats)
-                loss, _ = criterion(masks_pred, true_masks, compute_emd=False)
+                loss, _ = criterion(masks_pred, true_masks, compute_emd=False, long_ids=long_ids)
                 epoch_loss += loss.item()
+                epoch_iterations += criterion.iterations.float().mean()
 
                 pbar.set_postfix(**{'loss (batch)': loss.item()})
 
@@ -81,6 +102,7 @@ def train_net(net,
                 pbar.update(batch_size)
 
         logging.info('Train Loss: {0:.2f}m'.format(epoch_loss/n_batches))
+        logging.info('Train Sinkhorn iterations: {0:.2f}'.format(float(epoch_iterations)/n_batches))
 
         if save_cp:
             try:
@@ -92,14 +114,15 @@ def train_net(net,
                        dir_checkpoint + f'CP_epoch{epoch + 1}.pth')
             logging.info(f'Checkpoint {epoch + 1} saved !')
 
-        val_loss, val_emd = eval_net(net, val, device, num_examples)
+        val_loss, val_emd = eval_net(net, val, device, num_examples, loss_args)
         logging.info('Validation Loss: {0:.2f}m'.format(val_loss))
         logging.info('Validation EMD: {0:.2f}m'.format(val_emd))
 
-def evaluation(net, device, num_examples):
-    features = read_img_features()
+def evaluation(net, device, num_examples, half_features=False, loss_args={}):
+    features = FeatureTable(load_img_features(splits=['val']),
+                            dtype=np.float16 if half_features else np.float32)
     val = DataLoader(features, splits=['val'], bs=1)
-    val_loss, val_emd = eval_net(net, val, device, num_examples)
+    val_loss, val_emd = eval_net(net, val, device, num_examples, loss_args)
 
 
 def get_args():
@@ -117,6 +140,49 @@ def get_args():
                         help='Dropout on model layers during training', dest='model_dropout')
     parser.add_argument('-f', '--load', dest='load', type=str, default=False,
                         help='Load model from a .pth file')
+    parser.add_argument('-w', '--workers', metavar='W', type=int, default=0,
+                        help='Worker processes preparing training batches (0 to prepare them in the training loop)',
+                        dest='workers')
+    parser.add_argument('-dd', '--device-data', dest='device_data', action='store_true',
+                        help='Keep training data on the device and augment it there')
+    parser.add_argument('-hf', '--half-features', dest='half_features', action='store_true',
+                        help='Copy image features into a private float16 table, upcast per batch, '
+                             'instead of sharing the packed feature store in place')
+    parser.add_argument('-sc', '--sinkhorn-chunk', metavar='SC', type=int, default=None, dest='sinkhorn_chunk',
+                        help='Compute the Sinkhorn loss over chunks of this many rows, in O(batch*bins) memory')
+    parser.add_argument('-st', '--sparse-targets', dest='sparse_targets', action='store_true',
+                        help='Restrict the Sinkhorn loss to the support of each target distribution')
+    parser.add_argument('-si', '--sinkhorn-iters', metavar='SI', type=int, default=10, dest='sinkhorn_iters',
+                        help='Maximum number of Sinkhorn iterations in the loss')
+    parser.add_argument('-ig', '--implicit-grad', dest='implicit_grad', action='store_true',
+                        help='Use the entropic dual of the final Sinkhorn potentials as the loss and backpropagate from '
+                             'the potentials, not through the iterations')
+    parser.add_argument('-ce', '--sinkhorn-check', metavar='CE', type=int, default=1, dest='sinkhorn_check',
+                        help='Check Sinkhorn convergence every CE iterations (0 to always run all iterations)')
+    parser.add_argument('-dc', '--dual-cache', metavar='DC', type=int, default=0, dest='dual_cache',
+                        help='Warm start the training Sinkhorn loss from the cached potentials of up to DC examples '
+                             '(0 to disable). Changes the loss unless the iterations converge, evaluation never uses it')
+    parser.add_argument('-es', '--eps-start', metavar='ES', type=float, default=None, dest='eps_start',
+                        help='Anneal the Sinkhorn regularization from ES down to its final value (e.g. 1.0)')
+    parser.add_argument('-sb', '--sinkhorn-backend', default='sinkhorn', choices=['sinkhorn', 'sinkstep'],
+                        dest='sinkhorn_backend',
+                        help='Sinkhorn loss solver. Loss values differ between solvers at few iterations, '
+                             'see SinkhornImageLoss')
+    parser.add_argument('-ew', '--emd-workers', metavar='EW', type=int, default=0, dest='emd_workers',
+                        help='Worker processes solving the exact EMD in evaluation (0 to solve in this process)')
+    parser.add_argument('-fc', '--feature-cache', dest='feature_cache', action='store_true',
+                        help='Cache image branch outputs per viewpoint and feature version during evaluation')
+    parser.add_argument('-fp', '--fused-padding', dest='fused_padding', action='store_true',
+                        help='Fuse radial padding into the convolutions, padding with one gather')
+    parser.add_argument('-cl', '--channels-last', dest='channels_last', action='store_true',
+                        help='Run the model in channels_last memory format')
+    parser.add_argument('-ac', '--activation-checkpointing', dest='checkpointing', nargs='?', const=True,
+                        default=False, choices=['all'],
+                        help='Recompute block activations in the backward pass, trading step time for memory. '
+                             'By default only the blocks that free the most memory per recompute time '
+                             '(UNet.CHECKPOINT_BLOCKS), which costs little time. With all, every encoder and '
+                             'decoder block, which saves the most memory but recomputes most of the forward pass '
+                             '(about 25%% more step time on CPU)')
     parser.add_argument('-v', '--eval', dest='eval', action='store_true', help='Evaluate model')
     parser.add_argument('-ex', '--examples', metavar='EX', dest='examples', type=int, default=20,
                         help='Number of example predictions to save')
@@ -130,11 +196,14 @@ if __name__ == '__main__':
     device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
     logging.info(f'Using device {device}')
 
-    net = UNet(n_channels=2, n_classes=1, ch=64, dropout=args.model_dropout)
+    net = UNet(n_channels=2, n_classes=1, ch=64, dropout=args.model_dropout, fused_padding=args.fused_padding,
+               channels_last=args.channels_last, checkpointing=args.checkpointing)
     logging.info(f'Network:\n'
                  f'\t{net.n_channels} input channels\n'
                  f'\t{net.n_classes} output channels (classes)\n'
-                 f'\t{"Bilinear" if net.bilinear else "Dilated conv"} upscaling')
+                 f'\t{"Bilinear" if net.bilinear else "Dilated conv"} upscaling\n'
+                 f'\t{"Channels last" if net.channels_last else "Contiguous"} memory format\n'
+                 f'\tActivation checkpointing {", ".join(net.checkpoint_blocks) or "off"}')
 
     if args.load:
         net.load_state_dict(
@@ -143,10 +212,17 @@ if __name__ == '__main__':
         logging.info(f'Model loaded from {args.load}')
 
     net.to(device=device)
+    if args.feature_cache:
+        net.enable_feature_cache()
+    loss_args = dict(chunk_size=args.sinkhorn_chunk, sparse_targets=args.sparse_targets,
+                     max_iter=args.sinkhorn_iters, implicit=args.implicit_grad,
+                     check_every=args.sinkhorn_check, eps_start=args.eps_start,
+                     backend=args.sinkhorn_backend, emd_workers=args.emd_workers,
+                     dual_cache=DualCache(args.dual_cache) if args.dual_cache else None)
     # faster convolutions, but more memory
     # cudnn.benchmark = True
     if args.eval:
-        evaluation(net,device,args.examples)
+        evaluation(net,device,args.examples,half_features=args.half_features,loss_args=loss_args)
     else:
         try:
             train_net(net=net,
@@ -155,7 +231,11 @@ if __name__ == '__main__':
                       num_examples=args.examples,
                       lr=args.lr,
                       device=device,
-                      scan_dropout=args.scan_dropout)
+                      scan_dropout=args.scan_dropout,
+                      workers=args.workers,
+                      device_data=args.device_data,
+                      half_features=args.half_features,
+                      loss_args=loss_args)
         except KeyboardInterrupt:
             torch.save(net.state_dict(), 'INTERRUPTED.pth')
             logging.info('Saved interrupt')
@@ -1,44 +1,119 @@
 """ Full assembly of the parts to form the complete network """
 
+import torch
 import torch.nn.functional as F
+from collections import OrderedDict
 
 from .unet_parts import *
 
 
 class UNet(nn.Module):
-    def __init__(self, n_channels, n_classes, ch=64, bilinear=True, dropout=0.2):
+    BLOCKS = ('inc', 'down1', 'down2', 'down3', 'down4', 'up1', 'up2', 'up3', 'up4')
+    # Blocks that free more activation memory per ms of recompute than the model averages
+    # (about 0.5MB/ms at batch size 32), so checkpointing them costs little step time
+    CHECKPOINT_BLOCKS = ('inc', 'down4')
+
+    def __init__(self, n_channels, n_classes, ch=64, bilinear=True, dropout=0.2, fused_padding=False,
+                 channels_last=False, checkpointing=False):
+        """ Memory-lean options, which leave the outputs and checkpoint format unchanged:
+            fused_padding pads once per convolution with a single gather, channels_last
+            runs the convolutions in NHWC layout, and checkpointing recomputes block
+            activations in the backward pass in training. checkpointing=True only
+            checkpoints CHECKPOINT_BLOCKS, 'all' every encoder and decoder block, which
+            saves the most memory but recomputes most of the forward pass, or it can
+            be a list of block names. """
         super(UNet, self).__init__()
         self.n_channels = n_channels
         self.n_classes = n_classes
         self.bilinear = bilinear
+        self.channels_last = channels_last
+        if checkpointing is True:
+            checkpointing = self.CHECKPOINT_BLOCKS
+        elif checkpointing == 'all':
+            checkpointing = self.BLOCKS
+        self.checkpoint_blocks = tuple(checkpointing or ())
+        assert set(self.checkpoint_blocks) <= set(self.BLOCKS), 'Unknown blocks %s' % (checkpointing,)
 
-        self.inc = DoubleConv(n_channels, ch)
-        self.down1 = Down(ch, 2*ch)
-        self.down2 = Down(2*ch, 4*ch)
+        self.inc = DoubleConv(n_channels, ch, fused_padding)
+        self.down1 = Down(ch, 2*ch, fused_padding)
+        self.down2 = Down(2*ch, 4*ch, fused_padding)
         self.img = FeatureConv(2048, 8*ch, 6*4*ch)
         self.drop = nn.Dropout(p=dropout)
-        self.down3 = Down(8*ch, 8*ch)
-        self.down4 = Down(8*ch, 8*ch)
-        self.up1 = Up(16*ch, 4*ch, bilinear)
-        self.up2 = Up(12*ch, 2*ch, bilinear)
-        self.up3 = Up(4*ch, ch, bilinear)
-        self.up4 = Up(2*ch, ch, bilinear)
+        self.down3 = Down(8*ch, 8*ch, fused_padding)
+        self.down4 = Down(8*ch, 8*ch, fused_padding)
+        self.up1 = Up(16*ch, 4*ch, bilinear, fused_padding)
+        self.up2 = Up(12*ch, 2*ch, bilinear, fused_padding)
+        self.up3 = Up(4*ch, ch, bilinear, fused_padding)
+        self.up4 = Up(2*ch, ch, bilinear, fused_padding)
         self.outc = OutConv(ch, n_classes)
+        self.feature_cache = None
+        if channels_last:
+            self.to(memory_format=torch.channels_last)
+
+    def enable_feature_cache(self, max_entries=4096):
+        """ In eval mode, cache the image branch output of up to max_entries feature keys.
+            The image branch only mixes the 3 views at each heading, so the output for
+            rotated features is the cached output rolled by the same number of views.
+            Cleared on entering train mode or loading weights. """
+        self.feature_cache = OrderedDict()
+        self.feature_cache_size = max_entries
+
+    def clear_feature_cache(self):
+        if self.feature_cache is not None:
+            self.feature_cache.clear()
+
+    def train(self, mode=True):
+        if mode:
+            self.clear_feature_cache()
+        return super(UNet, self).train(mode)
 
-    def forward(self, scans, features):
+    def load_state_dict(self, *args, **kwargs):
+        self.clear_feature_cache()
+        return super(UNet, self).load_state_dict(*args, **kwargs)
+
+    def image_features(self, features, feature_keys=None, rotations=None):
+        """ Image branch output for features rolled by rotations views. feature_keys
+            identify the unrotated features, e.g. (long_id, feature version). """
+        if self.feature_cache is None or self.training or feature_keys is None:
+            return self.img(features)
+        if rotations is None:
+            rotations = [0]*len(feature_keys)
+        missing = [n for n, key in enumerate(feature_keys) if key not in self.feature_cache]
+        if missing:
+            computed = self.img(features[missing])
+            for out, n in zip(computed, missing):
+                self.feature_cache[feature_keys[n]] = torch.roll(out, -int(rotations[n]), dims=-1)
+        feats = []
+        for key, rotation in zip(feature_keys, rotations):
+            self.feature_cache.move_to_end(key)
+            feats.append(torch.roll(self.feature_cache[key], int(rotation), dims=-1))
+        while len(self.feature_cache) > self.feature_cache_size:
+            self.feature_cache.popitem(last=False)
+        return torch.stack(feats)
+
+    def forward(self, scans, features, feature_keys=None, rotations=None):
         # scans [batch_size, 2, 24, 48] - channels range and return type
         # features [batch_size, 2048, 3, 12]
+        # feature_keys and rotations optionally identify the features, see image_features
+        if self.channels_last:
+            scans = scans.contiguous(memory_format=torch.channels_last)
+            features = features.contiguous(memory_format=torch.channels_last)
+        checkpoint = self.checkpoint_blocks if self.training and torch.is_grad_enabled() else ()
+
+        def run(name, *inputs):
+            block = getattr(self, name)
+            return checkpoint_block(block, *inputs) if name in checkpoint else block(*inputs)
 
-        x1 = self.inc(scans)
-        x2 = self.down1(x1)
-        x3 = self.down2(x2)
-        feats = self.drop(self.img(features))
+        x1 = run('inc', scans)
+        x2 = run('down1', x1)
+        x3 = run('down2', x2)
+        feats = self.drop(self.image_features(features, feature_keys, rotations))
         x3 = torch.cat([feats.reshape(feats.shape[0], -1, x3.shape[-2], x3.shape[-1]),x3], dim=1)
-        x4 = self.down3(x3)
-        x5 = self.down4(x4)
-        x = self.up1(x5, x4)
-        x = self.up2(x, x3)
-        x = self.up3(x, x2)
-        x = self.up4(x, x1)
+        x4 = run('down3', x3)
+        x5 = run('down4', x4)
+        x = run('up1', x5, x4)
+        x = run('up2', x, x3)
+        x = run('up3', x, x2)
+        x = run('up4', x, x1)
         logits = self.outc(x)
         return logits
@@ -3,7 +3,7 @@
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-
+import torch.utils.checkpoint
 
 
 class RadialPad(nn.Module):
@@ -23,18 +23,117 @@ class RadialPad(nn.Module):
     return x2
 
 
+_pad_index = {}
+
+def radial_pad_index(height, width, top, bottom, left, right, device):
+  """ Flat indices into a (height, width) grid of each cell of its radial padding """
+  key = (height, width, top, bottom, left, right, device)
+  if key not in _pad_index:
+    rows = torch.arange(-top, height + bottom, device=device).clamp(0, height - 1)
+    cols = torch.arange(-left, width + right, device=device) % width
+    _pad_index[key] = (rows[:, None]*width + cols[None, :]).reshape(-1)
+  return _pad_index[key]
+
+
+def radial_gather(x, top, bottom, left, right):
+  """ Radial padding of x as a single gather, keeping channels_last inputs channels_last """
+  batch, channels, height, width = x.shape
+  index = radial_pad_index(height, width, top, bottom, left, right, x.device)
+  shape = (height + top + bottom, width + left + right)
+  if x.is_contiguous(memory_format=torch.channels_last) and not x.is_contiguous():
+    x = x.permute(0, 2, 3, 1).reshape(batch, height*width, channels)[:, index]
+    return x.view(batch, shape[0], shape[1], channels).permute(0, 3, 1, 2)
+  return x.reshape(batch, channels, height*width)[..., index].view(batch, channels, shape[0], shape[1])
+
+
+class FusedRadialPad(torch.autograd.Function):
+  """ radial_gather, with a backward pass that folds the gradient of the padding back onto
+      the edges with slices, which is much faster than the gather's scatter-add """
+
+  @staticmethod
+  def forward(ctx, x, top, bottom, left, right):
+    ctx.padding = (top, bottom, left, right)
+    return radial_gather(x, top, bottom, left, right)
+
+  @staticmethod
+  def backward(ctx, grad):
+    top, bottom, left, right = ctx.padding
+    height = grad.shape[2] - top - bottom
+    width = grad.shape[3] - left - right
+    # circular heading padding wraps around
+    grad_x = grad[:, :, :, left:left+width].clone()
+    if left:
+      grad_x[..., width-left:] += grad[..., :left]
+    if right:
+      grad_x[..., :right] += grad[..., left+width:]
+    # replicated range padding copies the first and last rows
+    grad_in = grad_x[:, :, top:top+height].clone()
+    if top:
+      grad_in[:, :, :1] += grad_x[:, :, :top].sum(dim=2, keepdim=True)
+    if bottom:
+      grad_in[:, :, -1:] += grad_x[:, :, top+height:].sum(dim=2, keepdim=True)
+    return grad_in, None, None, None, None
+
+
+@torch.fx.wrap
+def fused_radial_pad(x, top, bottom, left, right):
+  """ Replication padding of range and circular padding of heading as a single gather,
+      instead of a copy per padding mode. Keeps channels_last inputs channels_last.
+      Kept out of FX graphs, as its memory format branch cannot be traced, and traced
+      by jit as the plain gather, which TorchScript can save. """
+  if x.requires_grad and not torch.jit.is_tracing():
+    return FusedRadialPad.apply(x, top, bottom, left, right)
+  return radial_gather(x, top, bottom, left, right)
+
+
+class RadialConv2d(nn.Conv2d):
+  """ Conv2d with RadialPad fused into it """
+
+  def __init__(self, in_channels, out_channels, kernel_size, radial_padding):
+    super(RadialConv2d, self).__init__(in_channels, out_channels, kernel_size, padding=0)
+    self.radial_padding = radial_padding
+
+  def forward(self, x):
+    p = self.radial_padding
+    return self._conv_forward(fused_radial_pad(x, p, p, p, p), self.weight, self.bias)
+
+
+def checkpoint_block(block, *inputs):
+  """ Run block with activation checkpointing, so its activations are recomputed in the
+      backward pass instead of stored. BatchNorm buffers are restored after recomputing,
+      so running statistics are updated once per step. """
+  calls = []
+
+  def run(*inputs):
+    if not calls:
+      calls.append(True)
+      return block(*inputs)
+    norms = [m for m in block.modules() if isinstance(m, nn.modules.batchnorm._BatchNorm)]
+    buffers = [[b.clone() for b in m.buffers()] for m in norms]
+    try:
+      return block(*inputs)
+    finally:
+      with torch.no_grad():
+        for m, saved in zip(norms, buffers):
+          for b, value in zip(m.buffers(), saved):
+            b.copy_(value)
+
+  return torch.utils.checkpoint.checkpoint(run, *inputs, use_reentrant=False)
+
+
 class DoubleConv(nn.Module):
   """(convolution => [BN] => ReLU) * 2"""
 
-  def __init__(self, in_channels, out_channels):
+  def __init__(self, in_channels, out_channels, fused_padding=False):
     super().__init__()
+    # Fused padding keeps the module indices, so either loads the other's checkpoints
     self.double_conv = nn.Sequential(
-      RadialPad(1),
-      nn.Conv2d(in_channels, out_channels, kernel_size=3, padding=0),
+      nn.Identity() if fused_padding else RadialPad(1),
+      conv3x3(in_channels, out_channels, fused_padding),
       nn.BatchNorm2d(out_channels),
       nn.ReLU(inplace=True),
-      RadialPad(1),
-      nn.Conv2d(out_channels, out_channels, kernel_size=3, padding=0),
+      nn.Identity() if fused_padding else RadialPad(1),
+      conv3x3(out_channels, out_channels, fused_padding),
       nn.BatchNorm2d(out_channels),
       nn.ReLU(inplace=True)
     )
@@ -43,6 +142,12 @@ class DoubleConv(nn.Module):
     return self.double_conv(x)
 
 
+def conv3x3(in_channels, out_channels, fused_padding=False):
+  if fused_padding:
+    return RadialConv2d(in_channels, out_channels, kernel_size=3, radial_padding=1)
+  return nn.Conv2d(in_channels, out_channels, kernel_size=3, padding=0)
+
+
 class FeatureConv(nn.Module):
   """(convolution => [BN] => ReLU) * 2"""
 
@@ -64,22 +169,40 @@ class FeatureConv(nn.Module):
 class Down(nn.Module):
   """Downscaling with maxpool then double conv"""
 
-  def __init__(self, in_channels, out_channels):
+  def __init__(self, in_channels, out_channels, fused_padding=False):
     super().__init__()
     self.maxpool_conv = nn.Sequential(
         nn.MaxPool2d(2),
-        DoubleConv(in_channels, out_channels)
+        DoubleConv(in_channels, out_channels, fused_padding)
     )
 
   def forward(self, x):
     return self.maxpool_conv(x)
 
 
+@torch.fx.wrap
+def radial_pad(x1, x2, fused=False):
+  ''' Pad x1 to the size of x2, replicating ranges and wrapping headings. Kept out of FX
+      graphs, and with python int padding so traced and exported graphs pad by constants. '''
+  # input is CHW
+  diffY = int(x2.size()[2] - x1.size()[2])
+  diffX = int(x2.size()[3] - x1.size()[3])
+  if fused:
+    if diffY == 0 and diffX == 0:
+      return x1
+    return fused_radial_pad(x1, diffY // 2, diffY - diffY // 2, diffX // 2, diffX - diffX // 2)
+
+  # Radial padding
+  x1 = F.pad(x1, [0, 0, diffY // 2, diffY - diffY // 2], mode='replicate')
+  return F.pad(x1, [diffX // 2, diffX - diffX // 2, 0, 0], mode='circular')
+
+
 class Up(nn.Module):
   """Upscaling then double conv"""
 
-  def __init__(self, in_channels, out_channels, bilinear=True):
+  def __init__(self, in_channels, out_channels, bilinear=True, fused_padding=False):
     super().__init__()
+    self.fused_padding = fused_padding
 
     # if bilinear, use the normal convolutions to reduce the number of channels
     if bilinear:
@@ -87,17 +210,10 @@ class Up(nn.Module):
     else:
       self.up = nn.ConvTranspose2d(in_channels // 2, in_channels // 2, kernel_size=2, stride=2)
 
-    self.conv = DoubleConv(in_channels, out_channels)
+    self.conv = DoubleConv(in_channels, out_channels, fused_padding)
 
   def forward(self, x1, x2):
-    x1 = self.up(x1)
-    # input is CHW
-    diffY = x2.size()[2] - x1.size()[2]
-    diffX = x2.size()[3] - x1.size()[3]
-
-    # Radial padding
-    x1 = F.pad(x1, [0, 0, diffY // 2, diffY - diffY // 2], mode='replicate')
-    x1 = F.pad(x1, [diffX // 2, diffX - diffX // 2, 0, 0], mode='circular')
+    x1 = radial_pad(self.up(x1), x2, self.fused_padding)
     # if you have padding issues, see
     # https://github.com/HaiyongJiang/U-Net-Pytorch-Unstructured-Buggy/commit/0e854509c2cea854e247a9c615f175f76fbb2e3a
     # https://github.com/xiaopeng-liao/Pytorch-UNet/commit/8ebac70e633bac59fc22bb5195e513d5832fb3bd
@@ -1,4 +1,4 @@
-import sys
+import os
 import random
 import json
 import math
@@ -8,6 +8,8 @@ import time
 from collections import defaultdict
 from itertools import zip_longest
 
+from laser_scans import laser_scans_path, load_laser_scans
+
 random.seed(1)
 
 
@@ -15,6 +17,7 @@ random.seed(1)
 DATA_DIR = "data/"
 SIM_DIR = "../Matterport3DSimulator/"
 EXAMPLE_DIR = "examples/"
+CACHE_DIR = "cache/"
 IMAGENET_FEATURES = ['../Matterport3DSimulator/img_features/ResNet-152-imagenet.tsv']
 
 SCAN_HEIGHT = 0.24 # Height above floor in meters
@@ -27,40 +30,100 @@ RANGE_BIN_WIDTH = 0.2
 MAX_RANGE = RANGE_BINS*RANGE_BIN_WIDTH
 
 
-def read_img_features(feature_stores=IMAGENET_FEATURES):
-    import csv
-    csv.field_size_limit(sys.maxsize)
+def load_scenes(splits):
+    ''' Scene (scan) ids listed in splits/scenes_<split>.txt for the given splits '''
+    scenes = []
+    for split in splits:
+        scenes_file_path = "splits/scenes_" + split + ".txt"
+        with open(scenes_file_path) as f:
+            for line in f:
+                scenes.append(line.strip())
+    return scenes
+
+
+def _feature_byte_ranges(path, n_ranges):
+    ''' Split a file into roughly equal (start, end) byte ranges '''
+    size = os.path.getsize(path)
+    bounds = np.linspace(0, size, num=n_ranges+1).astype(np.int64)
+    return [(int(start), int(end)) for start, end in zip(bounds[:-1], bounds[1:]) if end > start]
+
+
+def _decode_feature_range(args):
+    ''' Decode the TSV rows that start inside a byte range, skipping scans
+        that are not in scenes. Returns (long_ids, features, skipped). '''
     import base64
-    from tqdm import tqdm
 
+    path, start, end, scenes = args
     views = 36
-    tsv_fieldnames = ['scanId', 'viewpointId', 'image_w', 'image_h', 'vfov', 'features']
+    long_ids = []
+    features = []
+    skipped = 0
+    with open(path, 'rb') as f:
+        if start > 0:
+            # The row straddling start belongs to the previous range
+            f.seek(start-1)
+            f.readline()
+        while f.tell() < end:
+            line = f.readline()
+            if not line.strip():
+                continue
+            # scanId, viewpointId, image_w, image_h, vfov, features
+            fields = line.rstrip(b'\r\n').split(b'\t')
+            scan = fields[0].decode('ascii')
+            if scenes is not None and scan not in scenes:
+                skipped += 1
+                continue
+            long_ids.append(scan + "_" + fields[1].decode('ascii'))
+            features.append(np.frombuffer(base64.b64decode(fields[5]), dtype=np.float32).reshape((views, -1)))
+    if features:
+        features = np.stack(features)
+    return long_ids, features, skipped
+
+
+def read_img_features(feature_stores=IMAGENET_FEATURES, splits=None, workers=None):
+    ''' Load image features from TSV. If splits are given, rows for scans outside those
+        splits are skipped before decoding. Each file is split into byte ranges
+        that are decoded in parallel by a pool of workers. '''
+    from multiprocessing import Pool
+
+    scenes = set(load_scenes(splits)) if splits is not None else None
+    workers = workers or os.cpu_count()
     features = defaultdict(list)
     for feature_store in feature_stores:
       print("Start loading image features from %s" % feature_store)
       start = time.time()
-      with open(feature_store, "r") as tsv_in_file:     # Open the tsv file.
-          reader = csv.DictReader(tsv_in_file, delimiter='\t', fieldnames=tsv_fieldnames)
-          for item in reader:
-              long_id = item['scanId'] + "_" + item['viewpointId']
-              features[long_id].append(np.frombuffer(base64.decodestring(item['features'].encode('ascii')),
-                                                     dtype=np.float32).reshape((views, -1)))   # Feature of long_id is (36, 2048)
-
-      print("Finish Loading the image features from %s in %0.4f seconds" % (feature_store, time.time() - start))
+      ranges = _feature_byte_ranges(feature_store, 4*workers)
+      rows = 0
+      skipped = 0
+      with Pool(workers) as pool:
+          # imap keeps file order, so multiple versions of a long_id stay in feature_stores order
+          for long_ids, feats, n_skipped in pool.imap(_decode_feature_range,
+                                                      [(feature_store, s, e, scenes) for s, e in ranges]):
+              for long_id, feat in zip(long_ids, feats):
+                  features[long_id].append(feat)   # Feature of long_id is (36, 2048)
+              rows += len(long_ids)
+              skipped += n_skipped
+      elapsed = time.time() - start
+      print("Finish Loading %d image features (skipped %d) from %s in %0.4f seconds (%0.1f rows/s)"
+            % (rows, skipped, feature_store, elapsed, (rows+skipped)/max(elapsed, 1e-6)))
     return features
 
 
 
-def load_data(splits, visualize=False, verbose=False):
-    ''' Load training / val data of laser scans plus heading and range to nearby waypoints '''
+def _load_data_sources(scenes):
+    ''' Source files of the laser / neighbor dataset with their mtime and size '''
+    paths = [SIM_DIR + 'connectivity/%s_connectivity.json' % scene for scene in scenes]
+    paths += [laser_scans_path(DATA_DIR + scene) for scene in scenes]
+    sources = {}
+    for path in paths:
+        stat = os.stat(path)
+        sources[path] = [stat.st_mtime_ns, stat.st_size]
+    return sources
 
-    # Load scenes
-    scenes = []
-    for split in splits:
-        scenes_file_path = "splits/scenes_" + split + ".txt"
-        with open(scenes_file_path) as f:
-            for line in f:
-                scenes.append(line.strip())
+
+def _compile_data(scenes, visualize=False):
+    ''' Parse the connectivity and laser scan json files of scenes into columnar
+        arrays. Targets of item i are target_heading[target_offsets[i]:target_offsets[i+1]]. '''
 
     # Load navigation graph connectivity info
     nb = {}
@@ -76,53 +139,110 @@ def load_data(splits, visualize=False, verbose=False):
 
     # Load generated laser scan data
     degree = []
-    dist = []
     dataset = []
     for scene in scenes:
-        laser_path = DATA_DIR + scene + "/laser_scans.json"
-        with open(laser_path) as jf:
-            json_data = json.load(jf)
-
-            # Build lookup by id
-            scans = {}
-            for item in json_data:
-                scans[item['image_id']] = item
-
-            # Identify neighbors to use as targets
-            for item in json_data:
-                target_heading = []
-                target_range = []
-                for n_id in nb[scene][item['image_id']]:
-                    if n_id in scans: # Some were missed if we couldn't identify floor level
-                        height_diff = item['position']['z'] - scans[n_id]['position']['z']
-                        item_range = distance(item['position'], scans[n_id]['position'])
-                        if abs(height_diff) < ALLOWED_HEIGHT_DIFF and item_range < MAX_RANGE:
-                            # Heading from centre of scan, right is positive, in range -pi to +pi
-                            target_heading.append(heading(item['position'], scans[n_id]['position']))
-                            target_range.append(item_range)
-                degree.append(len(target_heading))
-                if target_heading:
-                    dist += target_range
-                    item['laser'] = np.array(item['laser'])
-                    item['target_heading'] = np.array(target_heading)
-                    item['target_range'] = np.array(target_range)
-                    dataset.append(item)
-
+        # Binary laser_scans.bin if it has been converted, otherwise laser_scans.json
+        json_data = load_laser_scans(DATA_DIR + scene)
+
+        # Build lookup by id
+        scans = {}
+        for item in json_data:
+            scans[item['image_id']] = item
+
+        # Identify neighbors to use as targets
+        for item in json_data:
+            target_heading = []
+            target_range = []
+            for n_id in nb[scene][item['image_id']]:
+                if n_id in scans: # Some were missed if we couldn't identify floor level
+                    height_diff = item['position']['z'] - scans[n_id]['position']['z']
+                    item_range = distance(item['position'], scans[n_id]['position'])
+                    if abs(height_diff) < ALLOWED_HEIGHT_DIFF and item_range < MAX_RANGE:
+                        # Heading from centre of scan, right is positive, in range -pi to +pi
+                        target_heading.append(heading(item['position'], scans[n_id]['position']))
+                        target_range.append(item_range)
+            degree.append(len(target_heading))
+            if target_heading:
+                item['laser'] = np.array(item['laser'])
+                item['target_heading'] = np.array(target_heading)
+                item['target_range'] = np.array(target_range)
+                dataset.append(item)
+
+                if visualize:
                     img = radial_occupancy(item['laser'])
-                    if visualize:
-                        target = radial_target(item['target_heading'], item['target_range'])
-                        visualize_scan(img, target)
+                    target = radial_target(item['target_heading'], item['target_range'])
+                    visualize_scan(img, target)
+
+    lengths = [len(item['target_heading']) for item in dataset]
+    return {
+        'scan': np.array([item['scan'] for item in dataset], dtype=str),
+        'image_id': np.array([item['image_id'] for item in dataset], dtype=str),
+        'position': np.array([[item['position'][k] for k in 'xyz'] for item in dataset], dtype=np.float64).reshape(-1, 3),
+        'laser': np.stack([item['laser'] for item in dataset]) if dataset else np.empty((0, 0)),
+        'target_offsets': np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64),
+        'target_heading': np.concatenate([item['target_heading'] for item in dataset] + [np.empty(0)]),
+        'target_range': np.concatenate([item['target_range'] for item in dataset] + [np.empty(0)]),
+        'degree': np.array(degree, dtype=np.int64),
+    }
+
+
+def _read_data_cache(cache_path, key):
+    ''' Return the compiled columns in cache_path if its key matches, otherwise None '''
+    if not os.path.exists(cache_path):
+        return None
+    with np.load(cache_path) as cache:
+        if str(cache['key']) != key:
+            return None
+        return {name: cache[name] for name in cache.files if name != 'key'}
+
+
+def load_data(splits, visualize=False, verbose=False, cache_dir=CACHE_DIR):
+    ''' Load training / val data of laser scans plus heading and range to nearby waypoints.
+        The parsed dataset is compiled into a columnar cache per set of splits,
+        which is rebuilt when any source json changes. Set cache_dir=None to
+        always parse the json. '''
+
+    # Load scenes
+    scenes = load_scenes(splits)
+
+    cols = None
+    if cache_dir is not None and not visualize:
+        cache_path = os.path.join(cache_dir, 'dataset_%s.npz' % '_'.join(splits))
+        key = json.dumps({'scenes': scenes, 'sources': _load_data_sources(scenes),
+                          'allowed_height_diff': ALLOWED_HEIGHT_DIFF, 'max_range': MAX_RANGE}, sort_keys=True)
+        cols = _read_data_cache(cache_path, key)
+        if cols is None:
+            cols = _compile_data(scenes)
+            os.makedirs(cache_dir, exist_ok=True)
+            tmp_path = '%s.%d.tmp' % (cache_path, os.getpid())
+            with open(tmp_path, 'wb') as f:
+                np.savez(f, key=np.array(key), **cols)
+            os.replace(tmp_path, cache_path)
+    if cols is None:
+        cols = _compile_data(scenes, visualize)
+
+    dataset = []
+    offsets = cols['target_offsets']
+    for i in range(len(cols['scan'])):
+        x, y, z = cols['position'][i]
+        dataset.append({
+            'scan': str(cols['scan'][i]),
+            'image_id': str(cols['image_id'][i]),
+            'position': {'x': float(x), 'y': float(y), 'z': float(z)},
+            'laser': cols['laser'][i],
+            'target_heading': cols['target_heading'][offsets[i]:offsets[i+1]],
+            'target_range': cols['target_range'][offsets[i]:offsets[i+1]],
+        })
 
     if verbose:
         print("Loaded %d scans from %d scenes" % (len(dataset), len(scenes)))
-        print("Average of %.1f targets per scan" % np.average(np.array(degree)))
+        print("Average of %.1f targets per scan" % np.average(cols['degree']))
 
         print("\nHistogram of range\nBin\tFreq")
-        freqs,bins = np.histogram(np.array(dist), bins=20, range=(0,5), density=True)
+        freqs,bins = np.histogram(cols['target_range'], bins=20, range=(0,5), density=True)
         for f,b in zip(freqs,bins):
             print('%.2fm\t%.2f' % (b,f/np.sum(freqs)))
 
-    random.shuffle(data)
     return dataset
 
 
@@ -142,16 +262,51 @@ def bin_distance(range_bin1, heading_bin1, range_bin2, heading_bin2):
     return dist
 
 
-def radial_cost_matrix():
+def polar_bin_centres(range_bins=RANGE_BINS, heading_bins=HEADING_BINS, range_bin_width=RANGE_BIN_WIDTH):
+    ''' Cartesian (x, y) coordinates of every radial cell centre, each shaped
+        (range_bins, heading_bins). Matches polar_bins_to_cartesian exactly. '''
+    heading_bin_width = 2*math.pi/heading_bins
+    x = np.empty((range_bins, heading_bins))
+    y = np.empty((range_bins, heading_bins))
+    # Only range_bins*heading_bins trig calls, so use math (not numpy) to keep values bit-identical
+    for r in range(range_bins):
+      radius = (r+0.5)*range_bin_width
+      for h in range(heading_bins):
+        heading = (h+0.5)*heading_bin_width
+        x[r, h] = radius * math.cos(heading)
+        y[r, h] = radius * math.sin(heading)
+    return x, y
+
+
+def build_radial_cost_matrix(range_bins=RANGE_BINS, heading_bins=HEADING_BINS, range_bin_width=RANGE_BIN_WIDTH):
+    ''' Broadcasted construction of the (1, range_bins*heading_bins, range_bins*heading_bins)
+        matrix of distances in meters between all pairs of radial cells. '''
+    x, y = polar_bin_centres(range_bins, heading_bins, range_bin_width)
+    x = x.reshape(-1)
+    y = y.reshape(-1)
+    # float_power calls libm pow like the scalar ** in bin_distance, so results are bit-identical
+    C = np.sqrt(np.float_power(x[:, None] - x[None, :], 2) + np.float_power(y[:, None] - y[None, :], 2))
+    return C.reshape(1, range_bins*heading_bins, range_bins*heading_bins)
+
+
+def radial_cost_matrix(range_bins=RANGE_BINS, heading_bins=HEADING_BINS, range_bin_width=RANGE_BIN_WIDTH,
+                       cache_dir=CACHE_DIR):
     ''' Return a (1, RANGE_BINS*HEADING_BINS, RANGE_BINS*HEADING_BINS) cost
-        matrix.'''
-    C = np.zeros((1, RANGE_BINS, HEADING_BINS, RANGE_BINS, HEADING_BINS))
-    for r1 in range(RANGE_BINS):
-      for h1 in range(HEADING_BINS):
-        for r2 in range(RANGE_BINS):
-          for h2 in range(HEADING_BINS):
-            C[0, r1, h1, r2, h2] = bin_distance(r1, h1, r2, h2)
-    return C.reshape(1, RANGE_BINS*HEADING_BINS, RANGE_BINS*HEADING_BINS)
+        matrix. The matrix is cached on disk keyed by the grid parameters, set
+        cache_dir=None to always rebuild it. '''
+    if cache_dir is None:
+        return build_radial_cost_matrix(range_bins, heading_bins, range_bin_width)
+    cache_path = os.path.join(cache_dir, 'radial_cost_r%d_h%d_w%s.npy' % (range_bins, heading_bins, repr(range_bin_width)))
+    if os.path.exists(cache_path):
+        return np.load(cache_path)
+    C = build_radial_cost_matrix(range_bins, heading_bins, range_bin_width)
+    os.makedirs(cache_dir, exist_ok=True)
+    # Write then rename, so concurrent train / eval processes never read a partial file
+    tmp_path = '%s.%d.tmp' % (cache_path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+        np.save(f, C)
+    os.replace(tmp_path, cache_path)
+    return C
 
 
 def visualize_pred(scan, pred, gt, equi, i):
@@ -260,6 +415,13 @@ def normalize_angle(angle):
     return angle
 
 
+def normalize_angles(angles):
+    ''' Vectorized normalize_angle for a numpy array or torch tensor of angles. '''
+    angles = angles % (2*math.pi)
+    angles = (angles + (2*math.pi)) % (2*math.pi)
+    return angles - (2*math.pi)*(angles > math.pi)
+
+
 def heading(pos1, pos2):
     ''' Heading from pos1 to pos2. Matching the simulator, heading is defined 
         from the y-axis with the z-axis up (turning right is positive).'''
@@ -285,7 +447,8 @@ def radial_target(heading, dist):
                              HEADING_BIN_WIDTH*(HEADING_BINS/2+1), HEADING_BIN_WIDTH)
     range_bins = np.arange(0, RANGE_BIN_WIDTH*(RANGE_BINS+1), RANGE_BIN_WIDTH)
 
-    x = np.digitize(heading, heading_bins)-1
+    # A heading of +pi is the direction of -pi, so it wraps to the first bin
+    x = (np.digitize(heading, heading_bins)-1) % HEADING_BINS
     y = np.digitize(dist, range_bins)-1
 
     output[y,x] = 1
@@ -314,15 +477,152 @@ def radial_occupancy(scan):
     return output
 
 
+def _occupancy_from_top(top, has_return, range_bins):
+    ''' Expand the highest occupied range bin per heading column (B, HEADING_BINS)
+        into radial occupancy values (B, RANGE_BINS, HEADING_BINS). '''
+    r = np.arange(range_bins).reshape(1, -1, 1)
+    top = np.where(has_return, top, -1)[:, None, :]
+    return np.where(r < top, -1.0, np.where(r == top, 1.0, 0.0))
+
+
+def radial_occupancy_batch(scans):
+    ''' Batched radial_occupancy. Convert a (B, N) array of 360 degree range scans
+        into (B, RANGE_BINS, HEADING_BINS) radial occupancy maps in one pass. '''
+    scans = np.asarray(scans)
+    assert scans.ndim == 2 and scans.shape[1] % HEADING_BINS == 0
+    batch_size = scans.shape[0]
+    range_bins = np.arange(0, RANGE_BIN_WIDTH*(RANGE_BINS+1), RANGE_BIN_WIDTH)
+    chunk_size = scans.shape[1]//HEADING_BINS
+    # Same bin assignment as np.histogram: half open bins, except the last which is closed
+    y = np.digitize(scans, range_bins) - 1
+    y[scans == range_bins[-1]] = RANGE_BINS - 1
+    valid = np.logical_and(y >= 0, y < RANGE_BINS)
+    b, ix = np.nonzero(valid)
+    occupied = np.zeros((batch_size, RANGE_BINS, HEADING_BINS), dtype=bool)
+    occupied[b, y[b, ix], ix//chunk_size] = True
+    # Every cell closer than the furthest return in a column is free
+    has_return = occupied.any(axis=1)
+    top = RANGE_BINS - 1 - np.argmax(occupied[:, ::-1, :], axis=1)
+    return _occupancy_from_top(top, has_return, RANGE_BINS)
+
+
+def radial_target_batch(headings, dists):
+    ''' Batched radial_target. Takes ragged lists of B heading and distance arrays
+        and returns (B, RANGE_BINS, HEADING_BINS) radial encodings. '''
+    assert len(headings) == len(dists)
+    lengths = [len(h) for h in headings]
+    assert min(lengths) > 0
+    batch_size = len(headings)
+    output = np.zeros((batch_size, RANGE_BINS, HEADING_BINS))
+    b = np.repeat(np.arange(batch_size), lengths)
+    heading = np.concatenate(headings)
+    dist = np.concatenate(dists)
+    assert heading.shape == dist.shape
+    valid = np.logical_and(dist>0, dist<MAX_RANGE)
+
+    # Heading zero should be the middle of the array
+    heading_bins = np.arange(HEADING_BIN_WIDTH*-HEADING_BINS/2,
+                             HEADING_BIN_WIDTH*(HEADING_BINS/2+1), HEADING_BIN_WIDTH)
+    range_bins = np.arange(0, RANGE_BIN_WIDTH*(RANGE_BINS+1), RANGE_BIN_WIDTH)
+
+    # A heading of +pi is the direction of -pi, so it wraps to the first bin
+    x = (np.digitize(heading[valid], heading_bins)-1) % HEADING_BINS
+    y = np.digitize(dist[valid], range_bins)-1
+
+    output[b[valid],y,x] = 1
+    return output
+
+
+def radial_target_cells(heading, dist):
+    ''' Flat RANGE_BINS*HEADING_BINS cell index of each (heading, dist) target in
+        radial_target's encoding, or -1 for targets out of range '''
+    assert heading.shape == dist.shape
+    cells = np.full(heading.shape, -1, dtype=np.int64)
+    valid = np.logical_and(dist>0, dist<MAX_RANGE)
+    heading_bins = np.arange(HEADING_BIN_WIDTH*-HEADING_BINS/2,
+                             HEADING_BIN_WIDTH*(HEADING_BINS/2+1), HEADING_BIN_WIDTH)
+    range_bins = np.arange(0, RANGE_BIN_WIDTH*(RANGE_BINS+1), RANGE_BIN_WIDTH)
+    # A heading of +pi is the direction of -pi, so it wraps to the first bin, as in radial_target
+    x = (np.digitize(heading[valid], heading_bins)-1) % HEADING_BINS
+    y = np.digitize(dist[valid], range_bins)-1
+    cells[valid] = y*HEADING_BINS + x
+    return cells
+
+
+def radial_target_from_cells(cells):
+    ''' Render (B, K) flat target cells, padded with -1, as (B, RANGE_BINS, HEADING_BINS)
+        radial encodings '''
+    n_cells = RANGE_BINS*HEADING_BINS
+    output = np.zeros((cells.shape[0], n_cells+1))
+    # padding lands in a discarded extra cell
+    output[np.arange(cells.shape[0])[:, None], np.where(cells < 0, n_cells, cells)] = 1
+    return output[:, :n_cells].reshape(-1, RANGE_BINS, HEADING_BINS)
+
+
+def radial_occupancy_torch(scans):
+    ''' On-device radial_occupancy_batch. Takes a (B, N) tensor of range scans
+        and returns a (B, RANGE_BINS, HEADING_BINS) tensor of the same dtype.
+        Output matches radial_occupancy_batch exactly for float64 input. '''
+    import torch
+
+    assert scans.dim() == 2 and scans.shape[1] % HEADING_BINS == 0
+    batch_size = scans.shape[0]
+    # Bin in double precision so bin edges match the numpy version exactly
+    range_bins = torch.from_numpy(np.arange(0, RANGE_BIN_WIDTH*(RANGE_BINS+1), RANGE_BIN_WIDTH)).to(scans.device)
+    values = scans.to(torch.float64)
+    chunk_size = scans.shape[1]//HEADING_BINS
+    y = torch.bucketize(values, range_bins, right=True) - 1
+    y = torch.where(values == range_bins[-1], RANGE_BINS - 1, y)
+    valid = (y >= 0) & (y < RANGE_BINS)
+    ix = torch.arange(scans.shape[1], device=scans.device)//chunk_size
+    # Scatter into a padded grid so invalid returns land in a discarded row
+    flat = torch.where(valid, y, RANGE_BINS)*HEADING_BINS + ix
+    occupied = torch.zeros((batch_size, (RANGE_BINS+1)*HEADING_BINS), dtype=torch.bool, device=scans.device)
+    occupied.scatter_(1, flat, True)
+    occupied = occupied.reshape(batch_size, RANGE_BINS+1, HEADING_BINS)[:, :RANGE_BINS]
+    has_return = occupied.any(dim=1)
+    top = RANGE_BINS - 1 - occupied.flip(1).to(torch.uint8).argmax(dim=1)
+    top = torch.where(has_return, top, -1).unsqueeze(1)
+    r = torch.arange(RANGE_BINS, device=scans.device).reshape(1, -1, 1)
+    output = (r == top).to(scans.dtype) - (r < top).to(scans.dtype)
+    return output
+
+
+def radial_target_torch(heading, dist, batch_ix, batch_size):
+    ''' On-device radial_target_batch. Targets are given flattened, with batch_ix
+        holding the batch item of each (heading, dist) pair. Pairs with a range
+        outside (0, MAX_RANGE) are ignored, so padded targets can use range 0.
+        Returns a (batch_size, RANGE_BINS, HEADING_BINS) float tensor. Runs
+        without synchronizing with the host. '''
+    import torch
+
+    assert heading.shape == dist.shape == batch_ix.shape
+    device = heading.device
+    heading = heading.to(torch.float64).reshape(-1)
+    dist = dist.to(torch.float64).reshape(-1)
+    heading_bins = torch.from_numpy(np.arange(HEADING_BIN_WIDTH*-HEADING_BINS/2,
+                                     HEADING_BIN_WIDTH*(HEADING_BINS/2+1), HEADING_BIN_WIDTH)).to(device)
+    range_bins = torch.from_numpy(np.arange(0, RANGE_BIN_WIDTH*(RANGE_BINS+1), RANGE_BIN_WIDTH)).to(device)
+    valid = (dist > 0) & (dist < MAX_RANGE)
+    # A heading of +pi is the direction of -pi, so it wraps to the first bin, as in radial_target
+    x = (torch.bucketize(heading, heading_bins, right=True) - 1) % HEADING_BINS
+    y = torch.bucketize(dist, range_bins, right=True) - 1
+    # Scatter invalid targets into a discarded extra cell
+    n_cells = batch_size*RANGE_BINS*HEADING_BINS
+    flat = torch.where(valid, (batch_ix.reshape(-1)*RANGE_BINS + y)*HEADING_BINS + x, n_cells)
+    output = torch.zeros(n_cells+1, device=device)
+    output.scatter_(0, flat, 1.0)
+    return output[:-1].reshape(batch_size, RANGE_BINS, HEADING_BINS)
+
+
 
 if __name__ == "__main__":
 
     # Plot the laser scan of a particular viewpoint
-    with open('/home/peter/Data/mp3d/v1/scans/yZVvKaJZghh/laser_scans.json') as jf:
-      json_data = json.load(jf)
-      # Build lookup by id
-      scans = {}
-      for item in json_data:
+    json_data = load_laser_scans('/home/peter/Data/mp3d/v1/scans/yZVvKaJZghh/')
+    # Build lookup by id
+    scans = {}
+    for item in json_data:
         laser = np.array(item['laser'])
 
         # missing part of scan
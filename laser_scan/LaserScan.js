@@ -2,6 +2,7 @@
 
 THREE     = require("three");
 jsonfile  = require("jsonfile");
+fs        = require("fs");
 OBJLoader = require("./OBJLoader.js");
 OBJLoader(THREE);
 
@@ -10,6 +11,12 @@ var DATA_DIR = "<YOUR_PATH>/matterport/v1/scans/";
 var SIM_DIR = "<YOUR_PATH>/Matterport3DSimulator/";
 var SCAN_HEIGHT = 0.24; // above floor in meters
 var SCAN_VALUES = 1440 // 0.25 degrees, to match Hokuyo
+var OUTPUT_FORMAT = "json" // "json" for laser_scans.json, "bin" to stream laser_scans.bin
+
+// Binary format, see actions/laser_scans.py
+var BIN_HEADER_SIZE = 64;
+var BIN_ID_SIZE = 32;
+var BIN_NO_RETURN = 65535;
 
 
 // declare a bunch of variables we will need later
@@ -74,15 +81,44 @@ function laser_scan(position) {
   return values;
 }
 
+function open_laser_writer(outfile, scan) {
+  var fd = fs.openSync(outfile, "w");
+  var header = Buffer.alloc(BIN_HEADER_SIZE);
+  header.write("LASERSCN", 0, "ascii");
+  header.writeUInt32LE(1, 8); // version
+  header.writeUInt32LE(SCAN_VALUES, 12);
+  header.writeUInt32LE(BIN_ID_SIZE, 16);
+  header.write(scan, 20, "ascii");
+  fs.writeSync(fd, header);
+  return fd;
+}
+
+function write_laser_record(fd, image_id, position, laser) {
+  var record = Buffer.alloc(BIN_ID_SIZE + 3*8 + 2*SCAN_VALUES);
+  record.write(image_id, 0, "ascii");
+  record.writeDoubleLE(position.x, BIN_ID_SIZE);
+  record.writeDoubleLE(position.y, BIN_ID_SIZE + 8);
+  record.writeDoubleLE(position.z, BIN_ID_SIZE + 16);
+  for (var i=0; i<laser.length; i++) {
+    var mm = laser[i] < 0 ? BIN_NO_RETURN : Math.min(Math.round(laser[i]*1000), BIN_NO_RETURN-1);
+    record.writeUInt16LE(mm, BIN_ID_SIZE + 24 + 2*i);
+  }
+  fs.writeSync(fd, record);
+}
+
 function trace_connections(scan) {
   var url = SIM_DIR + "connectivity/" + scan + "_connectivity.json";
-  var outfile = DATA_DIR + scan + "/laser_scans.json";
+  var outfile = DATA_DIR + scan + "/laser_scans." + OUTPUT_FORMAT;
   jsonfile.readFile(url, function(error, data) {
     if (error) {
       return console.warn(error);
     }
     console.log("Laser scanning: "+ scan + ", " + data.length + " poses");
     var laser_scans = []
+    var fd = null;
+    if (OUTPUT_FORMAT == "bin") {
+      fd = open_laser_writer(outfile + ".tmp", scan);
+    }
     var down = new THREE.Vector3(0, 0, -1);
 
     // construct offsets for raytracing to floor
@@ -121,21 +157,31 @@ function trace_connections(scan) {
         } else {
           position = new THREE.Vector3(pose[3], pose[7], pose[11]-height+SCAN_HEIGHT);
           // Now do the actual scanning
-          laser_scans.push({
-            "image_id" : image_id,
-            "position": position,
-            "scan": scan,
-            "laser": laser_scan(position)
-          });
+          if (fd != null) {
+            // Stream each viewpoint to disk as it is scanned
+            write_laser_record(fd, image_id, position, laser_scan(position));
+          } else {
+            laser_scans.push({
+              "image_id" : image_id,
+              "position": position,
+              "scan": scan,
+              "laser": laser_scan(position)
+            });
+          }
           //console.log("Done: "+ scan + ", " + image_id);
         }
       }
     }
 
     console.log("Saving to " + outfile);
-    jsonfile.writeFile(outfile, laser_scans, function (err) {
-      console.error(err)
-    })
+    if (fd != null) {
+      fs.closeSync(fd);
+      fs.renameSync(outfile + ".tmp", outfile);
+    } else {
+      jsonfile.writeFile(outfile, laser_scans, function (err) {
+        console.error(err)
+      })
+    }
     process_next();
   });
 }